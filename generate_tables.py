@@ -1,4 +1,5 @@
 import json
+from src.store import experiment_summary, open_store
 from src.utils import get_results
 
 
@@ -81,6 +82,32 @@ def analise_tests(model_name, noises, amount_of_tests, folder_name):
     return ret
 
 
+def analise_store(model_name, noises, store_name):
+    # the same aggregates as analise_tests from a sweep result store
+    summary = experiment_summary(open_store(store_name), model_name)
+
+    ret = {}
+    for i in noises:
+        row = summary[str(i)]
+        ret[i] = {
+            k: row[k] if k in ("evaluated_systems", "time") else round(row[k], 5)
+            for k in [
+                "mean",
+                "min",
+                "max",
+                "dif_gp_original",
+                "min_system_value",
+                "max_system_value",
+                "dif_gp_noise",
+                "dif_gp_spline",
+                "evaluated_systems",
+                "time",
+            ]
+        }
+
+    return ret
+
+
 def print_latex_table(results, noises):
     text = """\\begin{tabular}{|c|c|c|c|c|c|}
 \hline  
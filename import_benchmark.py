@@ -0,0 +1,48 @@
+import json
+import subprocess
+import sys
+
+# modules every worker and command imports, none of them should load the
+# heavy dependencies until a feature that needs them is used
+MODULES = [
+    "src.genetic_algorithm",
+    "src.symbolic_regression",
+    "models.utils",
+    "models.sweep",
+    "src.service",
+]
+HEAVY = ["matplotlib", "sympy", "scipy", "csaps"]
+
+CODE = """
+import json, sys, timeit
+start = timeit.default_timer()
+import {module}
+stop = timeit.default_timer()
+heavy = sorted({{m.split(".")[0] for m in sys.modules}} & set({heavy!r}))
+print(json.dumps({{"time": stop - start, "heavy": heavy}}))
+"""
+
+
+def import_time(module, repeat=5):
+    # a new interpreter every time, nothing is imported beforehand
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", CODE.format(module=module, heavy=HEAVY)],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output))
+
+    return min(r["time"] for r in results), results[0]["heavy"]
+
+
+if __name__ == "__main__":
+    failed = False
+    for module in MODULES:
+        time, heavy = import_time(module)
+        print(f"{module:30} {time * 1000:8.1f} ms  {', '.join(heavy)}")
+        failed |= bool(heavy)
+
+    sys.exit(1 if failed else 0)
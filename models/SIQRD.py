@@ -23,7 +23,7 @@ def siqrd_system(X, t, alpha, beta, delta, gamma, mu):
     return [S_d, I_d, Q_d, R_d, D_d]
 
 
-def try_siqrd(noise, seed, name, save_to):
+def try_siqrd(noise, seed, name, save_to, genetic_params=None, plots="inline"):
     alpha = 0.2
     beta = 0.9
     delta = 0.1
@@ -72,12 +72,15 @@ def try_siqrd(noise, seed, name, save_to):
             "REG_STRENGTH": 30,
             "RANDOM_SELECTION_SIZE": 10,
             # "verbose": True,
+            **(genetic_params or {}),
         },
         add_N=["S", "I", "Q", "R", "D"],
         time=time,
         n=n,
         samples=samples,
         # show_spline=True,
+        trajectory_cache=os.path.join(os.path.dirname(save_to), "trajectories"),
+        plots=plots,
     )
 
 
@@ -9,7 +9,7 @@ def sir_dx(X, t, a, b):
     return [-a * I * S, a * I * S - b * I, b * I]
 
 
-def try_sir(noise, seed, name, save_to):
+def try_sir(noise, seed, name, save_to, genetic_params=None, plots="inline"):
     a = 0.3
     b = 0.1
 
@@ -48,11 +48,14 @@ def try_sir(noise, seed, name, save_to):
             "REG_STRENGTH": 20,
             "RANDOM_SELECTION_SIZE": 10,
             # "verbose": True,
+            **(genetic_params or {}),
         },
         time=time,
         n=n,
         samples=samples,
         # show_spline=True,
+        trajectory_cache=os.path.join(os.path.dirname(save_to), "trajectories"),
+        plots=plots,
     )
 
 
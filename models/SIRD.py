@@ -17,7 +17,9 @@ def sird_dx(X, t, a, b, c, d):
     return [S_d, I_d, R_d, D_d]
 
 
-def try_sird(noise, seed, name, save_to, samples=None):
+def try_sird(
+    noise, seed, name, save_to, samples=None, genetic_params=None, plots="inline"
+):
     a = 250
     b = 0.5
     c = 0.1
@@ -59,11 +61,14 @@ def try_sird(noise, seed, name, save_to, samples=None):
             "REG_STRENGTH": 40,
             "RANDOM_SELECTION_SIZE": 10,
             # "verbose": True,
+            **(genetic_params or {}),
         },
         add_N=["S", "I", "R"],
         time=time,
         samples=samples,
         # show_spline=True,
+        trajectory_cache=os.path.join(os.path.dirname(save_to), "trajectories"),
+        plots=plots,
     )
 
 
@@ -28,7 +28,7 @@ def svveir_system(X, t, alpha, beta, delta, gamma, mu, n, roh, omega, sigma):
     return [S_d, V1_d, V2_d, E_d, I_d, R_d]
 
 
-def try_svveir(noise, seed, name, save_to):
+def try_svveir(noise, seed, name, save_to, genetic_params=None, plots="inline"):
     alpha = 0.1
     beta = 0.7
     delta = 0.0005
@@ -82,12 +82,15 @@ def try_svveir(noise, seed, name, save_to):
             "REG_STRENGTH": 30,
             "RANDOM_SELECTION_SIZE": 10,
             # "verbose": True,
+            **(genetic_params or {}),
         },
         add_N=["S", "V1", "V2", "E", "I", "R"],
         time=time,
         n=n_integration,
         samples=samples,
         # show_spline=True,
+        trajectory_cache=os.path.join(os.path.dirname(save_to), "trajectories"),
+        plots=plots,
     )
 
 
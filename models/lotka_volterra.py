@@ -7,7 +7,7 @@ def lotka_volterra_dx(X, t, a, b, c, d):
     return [X[0] * (a - b * X[1]), -X[1] * (c - d * X[0])]
 
 
-def try_lotka_volterra(noise, seed, name, save_to):
+def try_lotka_volterra(noise, seed, name, save_to, genetic_params=None, plots="inline"):
     a = 0.04
     b = 0.0005
     c = 0.2
@@ -43,8 +43,11 @@ def try_lotka_volterra(noise, seed, name, save_to):
             "MAX_DEPTH": 10,
             "REG_STRENGTH": 15,
             # "verbose": True,
+            **(genetic_params or {}),
         },
         # show_spline=True,
+        trajectory_cache=os.path.join(os.path.dirname(save_to), "trajectories"),
+        plots=plots,
     )
 
 
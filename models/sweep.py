@@ -0,0 +1,203 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import sys
+import timeit
+import traceback
+from models.lotka_volterra import try_lotka_volterra
+from models.SIR import try_sir
+from models.SIRD import try_sird
+from models.SIQRD import try_siqrd
+from models.SVVEIR import try_svveir
+from models.utils import render_plots
+from src.store import import_run, open_store, stored_runs
+
+MODELS = {
+    "LV": try_lotka_volterra,
+    "SIR": try_sir,
+    "SIRD": try_sird,
+    "SIQRD": try_siqrd,
+    "SVVEIR": try_svveir,
+}
+
+DEFAULT_CONFIG = {
+    "models": list(MODELS),
+    "noises": [0.0, 0.05, 0.1, "original_model"],
+    "seeds": 30,
+    "save_to": "RESULTS",
+    "genetic_params": {},
+    "workers": 1,
+    "store": None,
+    "plots": "inline",
+    "plot_workers": 1,
+    "checkpoint_every": None,
+}
+
+
+def load_config(file_name):
+    with open(file_name) as fp:
+        return {**DEFAULT_CONFIG, **json.load(fp)}
+
+
+def sweep_tasks(config):
+    # the order of the tasks only depends on the config, so every machine
+    # running a shard of the sweep sees the same indexes
+    config = {**DEFAULT_CONFIG, **config}
+    seeds = config["seeds"]
+    if isinstance(seeds, int):
+        seeds = range(seeds)
+
+    tasks = []
+    for model in config["models"]:
+        for noise in config["noises"]:
+            for seed in seeds:
+                name = f"{model}_{seed}"
+                save_to = f"{config['save_to']}/{model}/noise_{noise}"
+                genetic_params = config["genetic_params"]
+
+                # interrupted runs resume from their last checkpoint
+                if config["checkpoint_every"]:
+                    genetic_params = {
+                        **genetic_params,
+                        "CHECKPOINT": f"{save_to}/checkpoint_{name}",
+                        "CHECKPOINT_EVERY": config["checkpoint_every"],
+                    }
+
+                tasks.append(
+                    {
+                        "index": len(tasks),
+                        "model": model,
+                        "noise": noise,
+                        "seed": seed,
+                        "name": name,
+                        "save_to": save_to,
+                        "genetic_params": genetic_params,
+                        "plots": config["plots"],
+                    }
+                )
+
+    return tasks
+
+
+def shard_tasks(tasks, shard=0, shards=1):
+    return [task for task in tasks if task["index"] % shards == shard]
+
+
+def status_file(task):
+    return f"{task['save_to']}/status_{task['name']}.json"
+
+
+def write_status(task, status, **info):
+    # written aside and renamed, readers never see a half written status
+    file_name = status_file(task)
+    tmp = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump({"task": task, "status": status, **info}, fp)
+    os.replace(tmp, file_name)
+
+
+def task_done(task):
+    # the results of the search and of the validation are both needed
+    try:
+        with open(f"{task['save_to']}/{task['name']}.json") as fp:
+            json.load(fp)
+        with open(f"{task['save_to']}/results_{task['name']}.json") as fp:
+            return "no_count" in json.load(fp)
+    except (OSError, ValueError):
+        return False
+
+
+def run_task(task):
+    os.makedirs(task["save_to"], exist_ok=True)
+    if task_done(task):
+        return "skipped"
+
+    write_status(task, "running", pid=os.getpid())
+    start = timeit.default_timer()
+    try:
+        MODELS[task["model"]](
+            task["noise"],
+            task["seed"],
+            task["name"],
+            task["save_to"],
+            genetic_params=task["genetic_params"],
+            plots=task["plots"],
+        )
+    except Exception:
+        write_status(
+            task,
+            "failed",
+            error=traceback.format_exc(),
+            time=timeit.default_timer() - start,
+        )
+        return "failed"
+
+    write_status(task, "done", time=timeit.default_timer() - start)
+    return "done"
+
+
+def run_sweep(config, shard=0, shards=1, workers=None, verbose=True):
+    config = {**DEFAULT_CONFIG, **config}
+    workers = workers or config["workers"]
+    tasks = shard_tasks(sweep_tasks(config), shard, shards)
+
+    summary = {"done": 0, "skipped": 0, "failed": 0, "plots_failed": 0}
+
+    # deferred figures are drawn by their own pool, never delaying the runs
+    plot_executor = None
+    plot_futures = {}
+    if config["plots"] == "deferred":
+        plot_executor = ProcessPoolExecutor(max_workers=config["plot_workers"])
+
+    # finished runs are appended to the result store by this process only
+    store = config["store"] and open_store(config["store"])
+    stored = stored_runs(store) if store else set()
+
+    def report(task, status):
+        summary[status] += 1
+        if verbose:
+            print(f"{task['index']} {task['name']} noise_{task['noise']} : {status}")
+
+        plots_file = f"{task['save_to']}/plots_{task['name']}"
+        if plot_executor and os.path.exists(f"{plots_file}.json"):
+            future = plot_executor.submit(render_plots, plots_file)
+            plot_futures[future] = task
+
+        key = (task["model"], str(task["noise"]), task["name"])
+        if store and status != "failed" and key not in stored:
+            import_run(
+                store,
+                task["model"],
+                task["noise"],
+                task["seed"],
+                task["name"],
+                task["save_to"],
+            )
+
+    if workers == 1:
+        for task in tasks:
+            report(task, run_task(task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_task, task): task for task in tasks}
+            for future in as_completed(futures):
+                report(futures[future], future.result())
+
+    if plot_executor:
+        for future in as_completed(plot_futures):
+            error = future.result()
+            if error:
+                summary["plots_failed"] += 1
+                if verbose:
+                    print(f"{plot_futures[future]['name']} plots : {error}")
+        plot_executor.shutdown()
+
+    return summary
+
+
+if __name__ == "__main__":
+    # python -m models.sweep config.json [shard shards]
+    config = load_config(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CONFIG
+    shard, shards = (int(i) for i in sys.argv[2:4]) if len(sys.argv) > 3 else (0, 1)
+
+    print(run_sweep(config, shard, shards))
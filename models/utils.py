@@ -1,35 +1,185 @@
 import csv
 import json
 import numpy as np
-from sympy.plotting.textplot import linspace
-from scipy import integrate
-import matplotlib.pyplot as plt
+import os
+import timeit
+from src.cache import cache_load, cache_save, content_hash
 from src.symbolic_regression import symbolic_regression
 from src.utils import (
-    evaluate,
+    compile_source,
     get_results,
     group_with_names,
-    load_samples,
+    jacobian_source,
+    load_samples_columns,
+    program_source,
     save_results,
     save_samples,
+    save_samples_columns,
     separate_samples,
-    take_n_samples_regular,
+    state_derivatives,
 )
 import warnings
 
 warnings.filterwarnings("error")
 
+# scipy and matplotlib are imported by the functions that use them, so
+# importing the module stays cheap for the workers
 
-def integrate_model(model, time, n, X0, *args):
-    t = linspace(0, time, n)
+
+def linspace(start, stop, num):
+    # the points of sympy.plotting.textplot.linspace
+    return [start + (stop - start) * x / (num - 1) for x in range(num)]
+
+
+def sample_times(time, n, samples):
+    # the times take_n_samples_regular keeps from linspace(0, time, n)
+    step = int(n / samples)
+    return [time * (i * step) / (n - 1) for i in range(samples)]
+
+
+def integrate_model(
+    model,
+    time,
+    n,
+    X0,
+    *args,
+    samples=None,
+    dense_output=False,
+    cache_dir=None,
+):
+    from scipy import integrate
+
+    # with samples only the sampled times are returned, the solver still
+    # chooses its own steps
+    t = linspace(0, time, n) if samples is None else sample_times(time, n, samples)
+
+    # the same trajectory is shared by every seed and noise level
+    key = None
+    if cache_dir and not dense_output:
+        key = content_hash(model, list(args), list(X0), time, n, samples)
+        cached = cache_load(cache_dir, key)
+        if cached is not None:
+            return (cached["t"], *cached["X"])
+
+    if dense_output:
+        solution = integrate.solve_ivp(
+            lambda t, X: model(X, t, *args),
+            (t[0], t[-1]),
+            X0,
+            method="LSODA",
+            t_eval=t,
+            dense_output=True,
+            rtol=1.49012e-8,
+            atol=1.49012e-8,
+        )
+        return (t, *solution.y, solution.sol)
 
     X, _ = integrate.odeint(model, X0, t, args, full_output=True)
 
     variables = X.T
 
+    if key:
+        cache_save(cache_dir, key, {"t": t, "X": variables}, {"model": model.__name__})
+
     return (t, *variables)
 
 
+class IntegrationBudget(Exception):
+    pass
+
+
+def reference_bound(validation_bound, *references):
+    # states beyond it are further than validation_bound from every reference
+    return validation_bound + max(np.max(np.abs(r)) for r in references)
+
+
+def integrate_system(
+    system,
+    X0,
+    t,
+    variable_names,
+    add_N=False,
+    bound=10000,
+    max_steps=100000,
+    max_time=60,
+):
+    # the discovered system is integrated only at the times in t, stopping as
+    # soon as the states are not finite, leave the bound or the budget is used
+    from scipy import integrate
+
+    features = {variable_names[0]: "t"}
+    features.update({name: f"Y[{i}]" for i, name in enumerate(variable_names[1:])})
+    if add_N:
+        features["N"] = "(" + " + ".join(features[j] for j in add_N) + ")"
+
+    namespace = {}
+    source = program_source(system, namespace, features, scalar=True)
+    rhs = compile_source(f"lambda t, Y: {source}", namespace)
+
+    # analytic jacobian, finite differences are used for systems with
+    # operations that can not be differentiated
+    try:
+        source = jacobian_source(
+            system,
+            state_derivatives(variable_names[1:], add_N),
+            namespace,
+            features,
+            scalar=True,
+        )
+        jacobian = compile_source(f"lambda t, Y: {source}", namespace)
+    except ValueError:
+        jacobian = None
+
+    steps = 0
+    deadline = timeit.default_timer() + max_time
+
+    def model(t, Y):
+        nonlocal steps
+        steps += 1
+        if steps > max_steps or timeit.default_timer() > deadline:
+            raise IntegrationBudget
+        return rhs(t, Y.tolist())
+
+    def non_finite(t, Y):
+        return 1.0 if np.all(np.isfinite(Y)) else -1.0
+
+    def blow_up(t, Y):
+        return bound - np.max(np.abs(Y))
+
+    def model_jacobian(t, Y):
+        return np.array(jacobian(t, Y.tolist()), dtype=float)
+
+    non_finite.terminal = blow_up.terminal = True
+
+    try:
+        with warnings.catch_warnings(), np.errstate(all="ignore"):
+            warnings.simplefilter("ignore")
+            solution = integrate.solve_ivp(
+                model,
+                (t[0], t[-1]),
+                X0,
+                method="LSODA",
+                t_eval=t,
+                events=(non_finite, blow_up),
+                jac=model_jacobian if jacobian else None,
+                rtol=1.49012e-8,
+                atol=1.49012e-8,
+            )
+    except IntegrationBudget:
+        return None, None, "budget"
+    except (ArithmeticError, ValueError):
+        return None, None, "non_finite"
+
+    if solution.status == 1:
+        termination = "non_finite" if len(solution.t_events[0]) else "blow_up"
+    elif solution.status == 0 and np.all(np.isfinite(solution.y)):
+        termination = "success"
+    else:
+        termination = "non_finite"
+
+    return solution.t, solution.y, termination
+
+
 def add_noise(target, max_noise, seed=None, noise_type="proportional"):
     rng = np.random.default_rng(seed)
 
@@ -43,6 +193,22 @@ def add_noise(target, max_noise, seed=None, noise_type="proportional"):
     return result
 
 
+def decimate(t, y, points):
+    # the minimum and maximum of every bucket of samples drawn in the same
+    # pixel column, the plot looks the same with far fewer points
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(t) <= 2 * points:
+        return t, y
+
+    edges = np.linspace(0, len(t), points + 1).astype(int)
+    index = []
+    for a, b in zip(edges[:-1], edges[1:]):
+        index += sorted({a + np.argmin(y[a:b]), a + np.argmax(y[a:b])})
+
+    return t[index], y[index]
+
+
 def plot_data(
     variables_names,
     t_samples=None,
@@ -55,24 +221,31 @@ def plot_data(
     samples_symbolic_regression=None,
     name=None,
 ):
+    import matplotlib.pyplot as plt
+
     plt.clf()
     figure = plt.gcf()
     figure.set_size_inches(15, 8)
+    pixels = int(figure.get_size_inches()[0] * figure.dpi)
 
     if samples:
         for i, variable_name in enumerate(variables_names):
-            plt.plot(t_samples, samples[i], label=f"{variable_name} samples")
+            plt.plot(
+                *decimate(t_samples, samples[i], pixels),
+                label=f"{variable_name} samples",
+            )
 
     if samples_noise:
         for i, variable_name in enumerate(variables_names):
             plt.plot(
-                t_noise, samples_noise[i], ".", label=f"{variable_name} samples noise"
+                *decimate(t_noise, samples_noise[i], pixels),
+                ".",
+                label=f"{variable_name} samples noise",
             )
     if samples_spline:
         for i, variable_name in enumerate(variables_names):
             plt.plot(
-                t_spline,
-                samples_spline[i],
+                *decimate(t_spline, samples_spline[i], pixels),
                 "--",
                 label=f"{variable_name} samples spline",
             )
@@ -80,8 +253,9 @@ def plot_data(
     if samples_symbolic_regression:
         for i, variable_name in enumerate(variables_names):
             plt.plot(
-                t_symbolic_regression,
-                samples_symbolic_regression[i],
+                *decimate(
+                    t_symbolic_regression, samples_symbolic_regression[i], pixels
+                ),
                 "-.",
                 label=f"{variable_name} symbolic regression",
             )
@@ -95,6 +269,34 @@ def plot_data(
     plt.show()
 
 
+def save_plots(plots, file_name):
+    # the arguments of plot_data of every figure, rendered later
+    def to_list(value):
+        if isinstance(value, str) or value is None:
+            return value
+        return [np.asarray(v).tolist() for v in value]
+
+    plots = [{k: to_list(v) for k, v in plot.items()} for plot in plots]
+
+    with open(f"{file_name}.json", "w") as fp:
+        json.dump(plots, fp)
+
+
+def render_plots(file_name):
+    # failures are reported, never raised, and pending plots are the ones
+    # with their file still there
+    try:
+        with open(f"{file_name}.json") as fp:
+            plots = json.load(fp)
+        for plot in plots:
+            plot_data(**plot)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+    os.remove(f"{file_name}.json")
+    return None
+
+
 def generate_experiment_results(
     model,
     X0,
@@ -108,32 +310,40 @@ def generate_experiment_results(
     time,
     n,
     samples,
+    validation_bound=10000,
+    validation_steps=100000,
+    validation_time=60,
+    trajectory_cache=None,
 ):
-    t, *X = integrate_model(model, time, n, X0, *params)
+    t_samples, *X_samples = integrate_model(
+        model, time, n, X0, *params, samples=samples, cache_dir=trajectory_cache
+    )
 
     results = get_results(f"{save_to}/{name}")
     best_system = results["system"]
 
-    def evaluate_symbolic_regression(X, t):
-        d = {
-            **{"t": t},
-            **{v_name: X[i] for i, v_name in enumerate(variable_names[1:])},
-        }
-        if add_N:
-            sum = 0
-            for j in add_N:
-                sum += d[j]
-            d["N"] = sum
-        return evaluate(best_system, d)
+    samples_columns = load_samples_columns(f"{save_to}/data_{name}")
+    t_noise, *X_noise = [samples_columns[v] for v in variable_names]
 
-    try:
-        X_gp, _ = integrate.odeint(
-            evaluate_symbolic_regression, X0, t, full_output=True
-        )
-        X_gp = X_gp.T.tolist()
-    except Warning:
+    t_spline, *X_spline = separate_samples(variable_names, results["X"])
+
+    # a system leaving the bound is further than validation_bound from every
+    # reference, the same systems the differences below leave out
+    _, X_gp_samples, termination = integrate_system(
+        best_system,
+        X0,
+        t_samples,
+        variable_names,
+        add_N,
+        reference_bound(validation_bound, X_samples, X_noise, X_spline),
+        validation_steps,
+        validation_time,
+    )
+
+    if termination != "success":
         dict_to_save = {
             "no_count": True,
+            "termination": termination,
         }
 
         file_name = f"{save_to}/results_{name}"
@@ -144,16 +354,6 @@ def generate_experiment_results(
             )
         return
 
-    t_samples, *X_samples = [take_n_samples_regular(samples, i) for i in [t, *X]]
-
-    t_noise, *X_noise = separate_samples(
-        variable_names, load_samples(f"{save_to}/data_{name}")
-    )
-
-    t_spline, *X_spline = separate_samples(variable_names, results["X"])
-
-    X_gp_samples = [take_n_samples_regular(samples, i) for i in X_gp]
-
     # con respecto a los datos de la integración del modelo original
     dif_gp_original = 0
     # con respecto a los datos con ruido
@@ -163,7 +363,7 @@ def generate_experiment_results(
     no_count = False
     for i in range(len(X_spline)):
         for j in range(len(X_spline[i])):
-            max_value = 10000
+            max_value = validation_bound
             assert t_samples[j] == t_noise[j] == t_spline[j]
             if (
                 abs(X_gp_samples[i][j] - X_samples[i][j]) > max_value
@@ -187,6 +387,7 @@ def generate_experiment_results(
         "dif_gp_noise": dif_gp_noise,
         "dif_gp_spline": dif_gp_spline,
         "no_count": no_count,
+        "termination": termination,
     }
 
     file_name = f"{save_to}/results_{name}"
@@ -214,21 +415,27 @@ def make_experiment(
     samples=300,
     show_spline=False,
     noise_type="proportional",
+    validation_bound=10000,
+    validation_steps=100000,
+    validation_time=60,
+    trajectory_cache=None,
+    plots="inline",
 ):
-    t, *X = integrate_model(model, time, n, X0, *params)
-
-    t_samples, *X_samples = [take_n_samples_regular(samples, i) for i in [t, *X]]
+    t_samples, *X_samples = integrate_model(
+        model, time, n, X0, *params, samples=samples, cache_dir=trajectory_cache
+    )
     if isinstance(noise, float):
         X_noise = [add_noise(x, noise, seed, noise_type) for x in X_samples]
     else:
         X_noise = X_samples
 
-    save_samples(
-        group_with_names([t_samples, *X_noise], variable_names),
-        f"{save_to}/data_{name}",
-    )
+    samples_data = group_with_names([t_samples, *X_noise], variable_names)
+    save_samples(samples_data, f"{save_to}/data_{name}")
+    save_samples_columns(samples_data, f"{save_to}/data_{name}")
 
     if show_spline:
+        import matplotlib.pyplot as plt
+
         for i, variable_name in enumerate(variable_names[1:]):
             plt.plot(t_samples, X_samples[i], label=f"{variable_name} samples")
 
@@ -254,39 +461,48 @@ def make_experiment(
     best_system = results["system"]
     save_results(results, f"{save_to}/{name}")
 
-    def evaluate_symbolic_regression(X, t):
-        d = {
-            **{"t": t},
-            **{v_name: X[i] for i, v_name in enumerate(variable_names[1:])},
-        }
-        if add_N:
-            d["N"] = sum(X)
-        return evaluate(best_system, d)
-
-    X_gp, _ = integrate.odeint(evaluate_symbolic_regression, X0, t, full_output=True)
-    X_gp = X_gp.T.tolist()
-
-    t_spline, *X_spline = separate_samples(variable_names, results["X"])
-
-    plot_data(
-        variables_names=variable_names[1:],
-        t_samples=t_samples,
-        samples=X_samples,
-        t_noise=t_samples,
-        samples_noise=X_noise,
-        t_spline=t_spline,
-        samples_spline=X_spline,
-        name=f"{save_to}/initial_plot_{name}.pdf",
-    )
-
-    plot_data(
-        variables_names=variable_names[1:],
-        t_samples=t_samples,
-        samples=X_samples,
-        t_symbolic_regression=t,
-        samples_symbolic_regression=X_gp,
-        name=f"{save_to}/final_plot_{name}.pdf",
-    )
+    # figures are drawn now, saved to be drawn by another process or skipped
+    if plots:
+        t_gp, X_gp, _ = integrate_system(
+            best_system,
+            X0,
+            t_samples,
+            variable_names,
+            add_N,
+            reference_bound(validation_bound, X_samples, X_noise),
+            validation_steps,
+            validation_time,
+        )
+        if X_gp is not None:
+            X_gp = X_gp.tolist()
+
+        t_spline, *X_spline = separate_samples(variable_names, results["X"])
+
+        figures = [
+            {
+                "variables_names": variable_names[1:],
+                "t_samples": t_samples,
+                "samples": X_samples,
+                "t_noise": t_samples,
+                "samples_noise": X_noise,
+                "t_spline": t_spline,
+                "samples_spline": X_spline,
+                "name": f"{save_to}/initial_plot_{name}.pdf",
+            },
+            {
+                "variables_names": variable_names[1:],
+                "t_samples": t_samples,
+                "samples": X_samples,
+                "t_symbolic_regression": t_gp,
+                "samples_symbolic_regression": X_gp,
+                "name": f"{save_to}/final_plot_{name}.pdf",
+            },
+        ]
+        if plots == "inline":
+            for figure in figures:
+                plot_data(**figure)
+        elif plots == "deferred":
+            save_plots(figures, f"{save_to}/plots_{name}")
 
     generate_experiment_results(
         model,
@@ -301,4 +517,8 @@ def make_experiment(
         time,
         n,
         samples,
+        validation_bound,
+        validation_steps,
+        validation_time,
+        trajectory_cache,
     )
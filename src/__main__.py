@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import sys
+from src.serialization import encode_program
+from src.store import open_store, store_run
+from src.symbolic_regression import symbolic_regression
+from src.utils import (
+    group_with_names,
+    load_samples_columns,
+    samples_file_name,
+    save_results,
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m src",
+        description="Find a system of differential equations for the samples.",
+    )
+    parser.add_argument(
+        "samples", help="sample file, a csv or a columns file (.cols) by name"
+    )
+    parser.add_argument(
+        "--variables",
+        nargs="+",
+        help="time followed by the state variables, all the columns by default",
+    )
+    parser.add_argument(
+        "--features",
+        type=json.loads,
+        help='features of every equation as json, as [["S", "I"], ["I"]]',
+    )
+    parser.add_argument("--add-N", nargs="+", help="variables summed into N")
+    parser.add_argument("--smoothing-factor", nargs="+", type=float)
+    parser.add_argument(
+        "--derivative-estimator",
+        help="central differences by default, or a spline with --smoothing-factor",
+    )
+    parser.add_argument("--derivative-options", type=json.loads)
+    parser.add_argument("--smoothing-selection", choices=["gcv", "holdout"])
+    parser.add_argument("--weak-form", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--params",
+        type=json.loads,
+        default={},
+        help='other symbolic_regression parameters as json, as {"POP_SIZE": 100}',
+    )
+    parser.add_argument(
+        "--seed-systems",
+        nargs="+",
+        help="results files, without .json, whose systems start the population",
+    )
+    parser.add_argument(
+        "--checkpoint", help="file name of the checkpoints, resumed when it exists"
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=10)
+    parser.add_argument("--spline-workers", type=int)
+    parser.add_argument("--cache-dir")
+    parser.add_argument("--save-to", help="file name of the results, without .json")
+    parser.add_argument("--store", help="result store to append the run to")
+    parser.add_argument("--model", help="model name in the store")
+    parser.add_argument("--noise", help="noise level in the store")
+    parser.add_argument("--name", help="run name in the store")
+    parser.add_argument("--verbose", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    # the spline needs a smoothing factor, given or selected
+    if (
+        args.derivative_estimator == "spline"
+        and not args.weak_form
+        and not args.smoothing_factor
+        and not args.smoothing_selection
+        and "smoothing_factor" not in (args.derivative_options or {})
+    ):
+        parser.error(
+            "--derivative-estimator spline needs --smoothing-factor "
+            "or --smoothing-selection"
+        )
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    file_name = samples_file_name(args.samples)
+    columns = load_samples_columns(file_name)
+
+    variable_names = args.variables or list(columns)
+    X = [columns[name].tolist() for name in variable_names]
+
+    results = symbolic_regression(
+        X,
+        variable_names,
+        args.smoothing_factor,
+        add_N=args.add_N or False,
+        seed_g=args.seed,
+        FEATURES_NAMES=args.features,
+        verbose=args.verbose,
+        SPLINE_WORKERS=args.spline_workers,
+        DERIVATIVE_ESTIMATOR=args.derivative_estimator,
+        DERIVATIVE_OPTIONS=args.derivative_options,
+        SMOOTHING_SELECTION=args.smoothing_selection,
+        CACHE_DIR=args.cache_dir,
+        WEAK_FORM=args.weak_form,
+        SEED_SYSTEMS=args.seed_systems,
+        CHECKPOINT=args.checkpoint,
+        CHECKPOINT_EVERY=args.checkpoint_every,
+        **args.params,
+    )
+    print(results["system_representation"])
+    print(f"score: {results['score']}")
+
+    if args.save_to:
+        save_results(dict(results), args.save_to)
+
+    if args.store:
+        name = args.name or os.path.basename(file_name)
+        store_run(
+            open_store(args.store),
+            args.model or name,
+            args.noise,
+            args.seed,
+            name,
+            {**results, "system": encode_program(results["system"])},
+            {},
+            group_with_names([columns[k] for k in columns], list(columns)),
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
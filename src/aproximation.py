@@ -1,37 +1,194 @@
-from csaps import csaps
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import timeit
+
+# csaps and scipy are imported by the estimators that use them, importing
+# the engine does not pay for them
 
 
 def derivate(x, y):
-    result = []
-    for i in range(len(y)):
-        result_i = []
-        for j in range(len(y[i])):
-            if j == len(y[i]) - 1:
-                break
-            result_i.append((y[i][j + 1] - y[i][j]) / (x[j + 1] - x[j]))
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    return (np.diff(y, axis=1) / np.diff(x)).tolist()
+
+
+def smoothing_spline(x, y, smoothing_factor, workers=None):
+    from csaps import csaps
+
+    def fit(i):
+        spline = csaps(x, y[i], smooth=smoothing_factor[i]).spline
+        return spline(x), spline.derivative(nu=1)(x)
+
+    # every variable is fitted independently
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            splines = list(executor.map(fit, range(len(y))))
+    else:
+        splines = [fit(i) for i in range(len(y))]
+
+    result_X = [x] + [s[0].tolist() for s in splines]
+    result_Dx = [s[1].tolist() for s in splines]
+
+    return result_X, result_Dx
+
+
+def forward_difference(x, y):
+    return [x[:-1]] + [y_i[:-1] for y_i in y], derivate(x, y)
+
+
+def spline(x, y, smoothing_factor, workers=None):
+    return smoothing_spline(x, y, smoothing_factor, workers)
+
+
+def savitzky_golay(x, y, window=11, polyorder=3):
+    # the filter assumes evenly spaced samples, as the ones taken by
+    # take_n_samples_regular
+    from scipy.signal import savgol_filter
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    window = min(window, len(x) - (1 - len(x) % 2))
+    delta = (x[-1] - x[0]) / (len(x) - 1)
+
+    values = savgol_filter(y, window, polyorder, axis=1)
+    dx = savgol_filter(y, window, polyorder, deriv=1, delta=delta, axis=1)
+
+    return [x.tolist()] + values.tolist(), dx.tolist()
+
+
+def finite_difference_weights(x, order):
+    # weights of a stencil of order + 1 points around every sample, shifted
+    # inside the grid at the borders, valid for non uniform grids
+    n = len(x)
+    points = order + 1
+    start = np.clip(np.arange(n) - points // 2, 0, n - points)
+    stencil = start[:, None] + np.arange(points)
+
+    h = x[stencil] - x[:, None]
+    powers = np.arange(points)
+    factorial = np.cumprod(np.maximum(powers, 1))
+    V = h[:, None, :] ** powers[None, :, None] / factorial[None, :, None]
+
+    rhs = np.zeros((n, points))
+    rhs[:, 1] = 1
+
+    return stencil, np.linalg.solve(V, rhs[:, :, None])[:, :, 0]
+
 
-        result.append(result_i)
+def finite_difference(x, y, order=4):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
 
-    return result
+    stencil, weights = finite_difference_weights(x, min(order, len(x) - 1))
+    dx = np.sum(y[:, stencil] * weights[None, :, :], axis=2)
 
+    return [x.tolist()] + y.tolist(), dx.tolist()
 
-def smoothing_spline(x, y, smoothing_factor):
-    y_spline = [
-        csaps(x, y_i, smooth=smoothing_factor[i]).spline for i, y_i in enumerate(y)
-    ]
 
-    y_spline_derivate = [x.derivative(nu=1) for x in y_spline]
+def central_difference(x, y):
+    return finite_difference(x, y, order=2)
+
+
+def total_variation(x, y, alpha=3, iterations=20, epsilon=1e-8):
+    # total variation denoising of the central differences, solved with
+    # lagged diffusivity, every iteration is a tridiagonal system
+    from scipy.linalg import solve_banded
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+
+    _, dx = central_difference(x, y)
+    dx = np.asarray(dx)
+    result = dx.copy()
 
-    result_X = [x]
-    result_Dx = []
     for i in range(len(y)):
-        result_i = []
-        result_i_dx = []
-        for j in x:
-            result_i.append(y_spline[i](j).item())
-            result_i_dx.append(y_spline_derivate[i](j).item())
+        # regularization relative to the noise level of the differences
+        scale = alpha * max(np.median(np.abs(np.diff(dx[i]))), epsilon)
+        u = dx[i]
+        for _ in range(iterations):
+            w = scale / np.sqrt(np.diff(u) ** 2 + epsilon)
 
-        result_X.append(result_i)
-        result_Dx.append(result_i_dx)
+            banded = np.zeros((3, n))
+            banded[0, 1:] = -w
+            banded[1] = 1
+            banded[1, :-1] += w
+            banded[1, 1:] += w
+            banded[2, :-1] = -w
 
-    return result_X, result_Dx
+            u = solve_banded((1, 1), banded, dx[i])
+        result[i] = u
+
+    return [x.tolist()] + y.tolist(), result.tolist()
+
+
+def smoothing_criterion(x, y, smooth, criterion="gcv", probes=None):
+    from csaps import csaps
+
+    x = np.asarray(x, dtype=float)
+
+    if criterion == "holdout":
+        # fit on three of every four samples and score the remaining ones
+        test = np.arange(len(x)) % 4 == 2
+        prediction = csaps(x[~test], y[:, ~test], smooth=smooth)(x[test])
+        return np.mean((prediction - y[:, test]) ** 2, axis=1)
+
+    # generalized cross validation, the trace of the hat matrix is estimated
+    # with random probes fitted together with the variables
+    n = len(x)
+    fitted = csaps(x, np.vstack((y, probes)), smooth=smooth)(x)
+    rss = np.mean((fitted[: len(y)] - y) ** 2, axis=1)
+    trace = np.mean(np.sum(probes * fitted[len(y) :], axis=1))
+
+    return rss / (1 - trace / n) ** 2
+
+
+def select_smoothing_factor(
+    x, y, grid=None, criterion="gcv", workers=None, probes=10, seed=0
+):
+    # from almost a straight line to almost an interpolation
+    grid = 1 / (1 + np.logspace(-5, 4, 19)) if grid is None else np.asarray(grid)
+    y = np.asarray(y, dtype=float)
+
+    rng = np.random.default_rng(seed)
+    probes = rng.choice([-1.0, 1.0], size=(probes, len(x)))
+
+    def score(smooth):
+        with np.errstate(all="ignore"):
+            return smoothing_criterion(x, y, smooth, criterion, probes)
+
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scores = np.array(list(executor.map(score, grid)))
+    else:
+        scores = np.array([score(smooth) for smooth in grid])
+
+    scores[~np.isfinite(scores)] = np.inf
+    best = np.argmin(scores, axis=0)
+
+    return [float(grid[i]) for i in best], scores.T.tolist()
+
+
+DERIVATIVE_ESTIMATORS = {
+    "forward": forward_difference,
+    "spline": spline,
+    "savitzky_golay": savitzky_golay,
+    "central": central_difference,
+    "finite_difference": finite_difference,
+    "total_variation": total_variation,
+}
+
+
+def estimate_derivative(estimator, x, y, **options):
+    start = timeit.default_timer()
+    result_X, result_Dx = DERIVATIVE_ESTIMATORS[estimator](x, y, **options)
+    stop = timeit.default_timer()
+
+    cost = {
+        "estimator": estimator,
+        "time": stop - start,
+        "samples": len(x) * len(y),
+    }
+
+    return result_X, result_Dx, cost
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+def content_hash(*items):
+    h = hashlib.sha256()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            h.update(str(item.dtype).encode())
+            h.update(str(item.shape).encode())
+            h.update(np.ascontiguousarray(item).tobytes())
+        elif callable(item):
+            h.update(marshal.dumps(item.__code__))
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+
+    return h.hexdigest()
+
+
+def cache_load(cache_dir, key):
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    try:
+        with open(os.path.join(path, "meta.json")) as fp:
+            meta = json.load(fp)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in meta["arrays"]
+        }
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # recently used entries are the last ones to be evicted
+    os.utime(path)
+
+    return {**arrays, "meta": meta}
+
+
+def cache_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def cache_evict(cache_dir, max_size):
+    entries = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if os.path.isdir(path) and not key.startswith("."):
+            entries.append((os.path.getmtime(path), cache_size(path), path))
+
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def cache_save(cache_dir, key, arrays, meta, max_size=None):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # written aside and renamed, readers never see a half written entry
+    tmp = tempfile.mkdtemp(prefix=".tmp_", dir=cache_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(array))
+    with open(os.path.join(tmp, "meta.json"), "w") as fp:
+        json.dump({**meta, "arrays": list(arrays)}, fp)
+
+    try:
+        os.rename(tmp, os.path.join(cache_dir, key))
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if max_size is not None:
+        cache_evict(cache_dir, max_size)
@@ -0,0 +1,71 @@
+import json
+import os
+import struct
+from src.serialization import read_programs, write_programs
+
+# groups of programs in the checkpoint, in the order they are written
+PROGRAMS = ["population", "population_optimized", "best_prog", "library_terms"]
+
+
+def save_checkpoint(file_name, state):
+    # a json header with the plain state followed by the stream of programs,
+    # the fitted systems missing for some survivors are left out
+    optimized = [i for i, p in enumerate(state["population_optimized"]) if p]
+    groups = {
+        "population": state["population"],
+        "population_optimized": [state["population_optimized"][i] for i in optimized],
+        "best_prog": [state["best_prog"]],
+        "library_terms": state["library_terms"],
+    }
+    header = {
+        **{k: v for k, v in state.items() if k not in PROGRAMS},
+        "sizes": [len(groups[k]) for k in PROGRAMS],
+        "optimized": optimized,
+        "random_state": [
+            state["random_state"][0],
+            list(state["random_state"][1]),
+            state["random_state"][2],
+        ],
+    }
+    header = json.dumps(header).encode()
+
+    # written aside and renamed, an interrupted run keeps the last one
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    tmp = f"{file_name}.ckpt.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fp:
+        fp.write(struct.pack("<I", len(header)))
+        fp.write(header)
+        write_programs((p for k in PROGRAMS for p in groups[k]), fp)
+    os.replace(tmp, f"{file_name}.ckpt")
+
+
+def load_checkpoint(file_name, key=None):
+    # None when there is no checkpoint or it belongs to another run
+    try:
+        with open(f"{file_name}.ckpt", "rb") as fp:
+            (length,) = struct.unpack("<I", fp.read(4))
+            checkpoint = json.loads(fp.read(length))
+            if key is not None and checkpoint.get("key") != key:
+                return None
+            programs = list(read_programs(fp))
+    except (OSError, ValueError, struct.error):
+        return None
+
+    groups = {}
+    for k, size in zip(PROGRAMS, checkpoint.pop("sizes")):
+        groups[k], programs = programs[:size], programs[size:]
+
+    population_optimized = [None] * len(groups["population"])
+    for i, program in zip(checkpoint.pop("optimized"), groups["population_optimized"]):
+        population_optimized[i] = program
+
+    version, internal, gauss = checkpoint["random_state"]
+
+    return {
+        **checkpoint,
+        "population": groups["population"],
+        "population_optimized": population_optimized,
+        "best_prog": groups["best_prog"][0],
+        "library_terms": groups["library_terms"],
+        "random_state": (version, tuple(internal), gauss),
+    }
@@ -0,0 +1,51 @@
+import numpy as np
+from src.library import build_library, library_matrix
+from src.utils import samples_to_columns
+
+
+def normalized_magnitude(X):
+    ret = np.zeros(len(X[0]))
+    for x in X:
+        x = np.abs(np.asarray(x, dtype=float))
+        if x.max() > 0:
+            ret += x / x.max()
+
+    return ret
+
+
+def derivative_importance(t, X_dx):
+    return normalized_magnitude(X_dx)
+
+
+def curvature_importance(t, X_dx):
+    return normalized_magnitude([np.gradient(np.asarray(x), t) for x in X_dx])
+
+
+def leverage_importance(X_samples, features_names):
+    library = build_library(samples_to_columns(X_samples), features_names, 1)
+    A = library_matrix(library)
+    A = A / np.maximum(np.abs(A).max(axis=0), 1e-300)
+
+    U, s, _ = np.linalg.svd(A, full_matrices=False)
+    rank = np.sum(s > s[0] * 1e-10)
+
+    return np.sum(U[:, :rank] ** 2, axis=1)
+
+
+def select_coreset(importance, CORESET_SIZE, uniform=0.2):
+    n = len(importance)
+    if CORESET_SIZE >= n:
+        return list(range(n)), [1] * n
+
+    # mix with the uniform distribution so flat regions keep some points
+    p = (1 - uniform) * importance / importance.sum() + uniform / n
+
+    # points at equally spaced quantiles of the importance mass, each one
+    # weighted by the amount of samples it stands for
+    quantiles = (np.arange(CORESET_SIZE) + 0.5) / CORESET_SIZE
+    rows = np.unique(np.minimum(np.searchsorted(np.cumsum(p), quantiles), n - 1))
+
+    bounds = np.concatenate(([0], (rows[1:] + rows[:-1]) // 2 + 1, [n]))
+    weights = np.diff(bounds)
+
+    return rows.tolist(), weights.tolist()
@@ -1,17 +1,30 @@
-from random import randint, random, seed
+from random import getstate, randint, random, sample, seed, setstate
 from math import *
-from src.lineal_optimization import compute_fitness, lineal_optimization_system
+from src.cache import content_hash
+from src.checkpoint import load_checkpoint, save_checkpoint
+from src.interval import bounded_system, feature_intervals
+from src.library import (
+    build_library,
+    library_index,
+    mutate_library_system,
+    random_library_system,
+)
+from src.lineal_optimization import compute_fitness, lineal_optimization_system_columns
 from src.mutate import mutate_system
 import timeit
 from src.operation import ADD, DIV, MUL, NEG, SUB
 from src.random_prog import random_system
+from src.simulation import simulation_errors
 from src.xover import xover
 from src.utils import (
     evaluate,
     filter_zero_terms_edo_system,
+    get_results,
     render_prog,
     round_terms_edo_system,
+    samples_to_columns,
 )
+import numpy as np
 
 
 def get_random_parent(population):
@@ -28,11 +41,24 @@ def get_mutate_population(
     CHANGE_OPERATION_PROBABILITY,
     DELETE_NODE_PROBABILITY,
     ADD_OPERATION_PROBABILITY,
+    library=None,
+    LIBRARY_MUTATION_PROBABILITY=0,
 ):
     mutations_populations = []
     for _ in range(MUTATION_SIZE):
         selected = get_random_parent(population)
 
+        if library and random() < LIBRARY_MUTATION_PROBABILITY:
+            mutations_populations.append(
+                mutate_library_system(
+                    selected=selected,
+                    library=library,
+                    DELETE_NODE_PROBABILITY=DELETE_NODE_PROBABILITY,
+                    ADD_OPERATION_PROBABILITY=ADD_OPERATION_PROBABILITY,
+                )
+            )
+            continue
+
         mutations_populations.append(
             mutate_system(
                 selected=selected,
@@ -60,6 +86,57 @@ def get_xover_population(population, XOVER_SIZE, MAX_DEPTH):
     return xover_population
 
 
+def get_fidelity_rows(n, FIDELITY_SIZE, FIDELITY_SAMPLING):
+    size = max(1, int(n * FIDELITY_SIZE))
+    if size >= n:
+        return None
+
+    # one row from each of `size` consecutive blocks of the trajectory
+    if FIDELITY_SAMPLING == "stratified":
+        bounds = [n * i // size for i in range(size + 1)]
+        return [randint(bounds[i], bounds[i + 1] - 1) for i in range(size)]
+
+    return sorted(sample(range(n), size))
+
+
+def fit_program(
+    prog,
+    X_columns,
+    target,
+    REG_STRENGTH,
+    library=None,
+    rows=None,
+    weights=None,
+    projection=None,
+):
+    # floating point errors are detected on the results, not raised
+    with np.errstate(all="ignore"):
+        try:
+            optimized_program, prediction = lineal_optimization_system_columns(
+                system=prog,
+                X_columns=X_columns,
+                target=target,
+                rows=rows,
+                weights=weights,
+                library=library,
+                projection=projection,
+            )
+        except np.linalg.LinAlgError:
+            return prog, None
+
+        if prediction is None:
+            return optimized_program, None
+
+        if rows is not None:
+            target = target[rows]
+            if weights is not None:
+                weights = weights[rows]
+
+        return optimized_program, compute_fitness(
+            optimized_program, prediction, target, REG_STRENGTH, weights
+        )
+
+
 def genetic_algorithm(
     X,
     target,
@@ -79,6 +156,24 @@ def genetic_algorithm(
     EPSILON=1e-7,
     ROUND_SIZE=5,
     verbose=False,
+    LIBRARY_DEPTH=None,
+    LIBRARY_MUTATION_PROBABILITY=0.5,
+    FIDELITY_SIZE=None,
+    FIDELITY_THRESHOLD=1.0,
+    FIDELITY_SAMPLING="random",
+    WEIGHTS=None,
+    INTERVAL_LIMIT=None,
+    PENALTY_FITNESS=1e30,
+    SIMULATION_TOP_K=None,
+    SIMULATION_SUBSTEPS=4,
+    SIMULATION_BOUND=100,
+    SIMULATION_METHOD="rk4",
+    SEED_SYSTEMS=None,
+    CHECKPOINT=None,
+    CHECKPOINT_EVERY=10,
+    add_N=False,
+    projection=None,
+    progress=None,
 ):
     start = timeit.default_timer()
 
@@ -89,19 +184,118 @@ def genetic_algorithm(
 
     operations = (ADD, SUB, MUL, DIV, NEG)
 
-    population = [
-        random_system(
-            system_lenght=system_lenght,
-            operations=operations,
-            features_names=features_names,
-            MAX_DEPTH=MAX_DEPTH,
+    X_columns = samples_to_columns(X)
+    target_array = np.array(target, dtype=float)
+    weights = None if WEIGHTS is None else np.array(WEIGHTS, dtype=float)
+
+    library = None
+    if LIBRARY_DEPTH is not None:
+        library = build_library(
+            X_columns, features_names, LIBRARY_DEPTH, projection=projection
         )
-        for _ in range(POP_SIZE)
+
+        population = [
+            random_library_system(
+                system_lenght=system_lenght, library=library, MAX_DEPTH=MAX_DEPTH
+            )
+            for _ in range(POP_SIZE)
+        ]
+    else:
+        population = [
+            random_system(
+                system_lenght=system_lenght,
+                operations=operations,
+                features_names=features_names,
+                MAX_DEPTH=MAX_DEPTH,
+            )
+            for _ in range(POP_SIZE)
+        ]
+
+    # systems found by previous runs, or their results files, take the place
+    # of the first random systems
+    seed_systems = [
+        get_results(system)["system"] if isinstance(system, str) else system
+        for system in SEED_SYSTEMS or []
     ]
+    seed_systems = [s for s in seed_systems if len(s["children"]) == system_lenght]
+    population[: len(seed_systems)] = seed_systems[:POP_SIZE]
+
+    intervals = None
+    if INTERVAL_LIMIT is not None:
+        intervals = feature_intervals(X_columns)
+
+    # full data scores of the survivors, None when they are not known
+    population_fitness = [None] * len(population)
+    population_optimized = [None] * len(population)
+    full_evaluations = 0
+    interval_rejected = 0
+    nonfinite_rejected = 0
+    rejected_per_generation = []
+    simulation_diverged = 0
 
     global_best = float("inf")
-    gen = 0
-    for gen in range(MAX_GENERATIONS):
+    best_prog = population[0]
+    first_generation = 0
+
+    # an interrupted run starts again from the end of its last checkpointed
+    # generation, with the same random state it had
+    # of the same samples and settings, only MAX_GENERATIONS can be raised
+    checkpoint_key = CHECKPOINT and content_hash(
+        list(X_columns),
+        *X_columns.values(),
+        target_array,
+        weights,
+        projection,
+        features_names,
+        {
+            "seed_g": seed_g,
+            "MAX_DEPTH": MAX_DEPTH,
+            "POP_SIZE": POP_SIZE,
+            "VARIABLE_PROBABILITY": VARIABLE_PROBABILITY,
+            "CHANGE_OPERATION_PROBABILITY": CHANGE_OPERATION_PROBABILITY,
+            "DELETE_NODE_PROBABILITY": DELETE_NODE_PROBABILITY,
+            "ADD_OPERATION_PROBABILITY": ADD_OPERATION_PROBABILITY,
+            "XOVER_SIZE": XOVER_SIZE,
+            "MUTATION_SIZE": MUTATION_SIZE,
+            "RANDOM_SELECTION_SIZE": RANDOM_SELECTION_SIZE,
+            "REG_STRENGTH": REG_STRENGTH,
+            "LIBRARY_DEPTH": LIBRARY_DEPTH,
+            "LIBRARY_MUTATION_PROBABILITY": LIBRARY_MUTATION_PROBABILITY,
+            "FIDELITY_SIZE": FIDELITY_SIZE,
+            "FIDELITY_THRESHOLD": FIDELITY_THRESHOLD,
+            "FIDELITY_SAMPLING": FIDELITY_SAMPLING,
+            "INTERVAL_LIMIT": INTERVAL_LIMIT,
+            "PENALTY_FITNESS": PENALTY_FITNESS,
+            "SIMULATION_TOP_K": SIMULATION_TOP_K,
+            "SIMULATION_SUBSTEPS": SIMULATION_SUBSTEPS,
+            "SIMULATION_BOUND": SIMULATION_BOUND,
+            "SIMULATION_METHOD": SIMULATION_METHOD,
+            "add_N": add_N,
+        },
+    )
+    checkpoint = CHECKPOINT and load_checkpoint(CHECKPOINT, checkpoint_key)
+    if checkpoint:
+        # the terms added to the library by the fits are added again in the
+        # same order, so they keep their indexes
+        for term in checkpoint["library_terms"]:
+            library_index(library, term, X_columns)
+
+        population = checkpoint["population"]
+        population_fitness = checkpoint["population_fitness"]
+        population_optimized = checkpoint["population_optimized"]
+        global_best = checkpoint["global_best"]
+        best_prog = checkpoint["best_prog"]
+        first_generation = checkpoint["generation"]
+        full_evaluations = checkpoint["full_evaluations"]
+        interval_rejected = checkpoint["interval_rejected"]
+        nonfinite_rejected = checkpoint["nonfinite_rejected"]
+        rejected_per_generation = checkpoint["rejected_per_generation"]
+        simulation_diverged = checkpoint["simulation_diverged"]
+        start -= checkpoint["time"]
+        setstate(checkpoint["random_state"])
+
+    gen = max(first_generation - 1, 0)
+    for gen in range(first_generation, MAX_GENERATIONS):
         mutations_population = get_mutate_population(
             population=population,
             MUTATION_SIZE=MUTATION_SIZE,
@@ -112,6 +306,8 @@ def genetic_algorithm(
             CHANGE_OPERATION_PROBABILITY=CHANGE_OPERATION_PROBABILITY,
             DELETE_NODE_PROBABILITY=DELETE_NODE_PROBABILITY,
             ADD_OPERATION_PROBABILITY=ADD_OPERATION_PROBABILITY,
+            library=library,
+            LIBRARY_MUTATION_PROBABILITY=LIBRARY_MUTATION_PROBABILITY,
         )
 
         xover_population = get_xover_population(
@@ -120,49 +316,196 @@ def genetic_algorithm(
 
         total_population = population + mutations_population + xover_population
 
+        # offspring are screened on a subset of rows that grows every
+        # generation, only the promising ones are fitted on the full data
+        rows = None
+        known_fitness = [f for f in population_fitness if f is not None]
+        if FIDELITY_SIZE and known_fitness:
+            rows = get_fidelity_rows(
+                len(target_array),
+                FIDELITY_SIZE + (1 - FIDELITY_SIZE) * gen / MAX_GENERATIONS,
+                FIDELITY_SAMPLING,
+            )
+            survivors_worst = max(known_fitness)
+
+        rejected = 0
         fitness = []
+        full_fitness = []
+        optimized = {}
         for i_prog, prog in enumerate(total_population):
             if verbose:
                 print(f"{i_prog + 1}/{len(total_population)}", end="\r")
 
-            optimized_program = prog
-            optimized_program = lineal_optimization_system(
-                system=prog, X=X, target=target
+            if FIDELITY_SIZE and i_prog < len(population):
+                if population_fitness[i_prog] is not None:
+                    fitness.append(population_fitness[i_prog])
+                    full_fitness.append(True)
+                    optimized[i_prog] = population_optimized[i_prog]
+                    continue
+
+            # terms whose range on the data blows up are never evaluated
+            if intervals and not bounded_system(prog, intervals, INTERVAL_LIMIT):
+                interval_rejected += 1
+                rejected += 1
+                fitness.append(PENALTY_FITNESS)
+                full_fitness.append(False)
+                continue
+
+            if rows is not None:
+                _, score = fit_program(
+                    prog,
+                    X_columns,
+                    target_array,
+                    REG_STRENGTH,
+                    library,
+                    rows,
+                    weights,
+                    projection,
+                )
+                if score is None:
+                    nonfinite_rejected += 1
+                    rejected += 1
+                    fitness.append(PENALTY_FITNESS)
+                    full_fitness.append(False)
+                    continue
+
+                if score > FIDELITY_THRESHOLD * survivors_worst:
+                    fitness.append(score)
+                    full_fitness.append(False)
+                    continue
+
+            optimized_program, score = fit_program(
+                prog,
+                X_columns,
+                target_array,
+                REG_STRENGTH,
+                library,
+                None,
+                weights,
+                projection,
             )
+            full_evaluations += 1
 
-            prediction = [evaluate(optimized_program, Xi) for Xi in X]
-            score = compute_fitness(optimized_program, prediction, target, REG_STRENGTH)
-
-            if score < global_best:
-                global_best = score
-                best_prog = optimized_program
+            # programs with non finite columns or predictions are penalized
+            if score is None:
+                nonfinite_rejected += 1
+                rejected += 1
+                fitness.append(PENALTY_FITNESS)
+                full_fitness.append(False)
+                continue
 
             fitness.append(score)
+            full_fitness.append(True)
+            optimized[i_prog] = optimized_program
+
+        # the best programs keep their scores but are selected first, in the
+        # order of how well they reproduce the trajectory, the diverging ones
+        # are penalized
+        trajectory_errors = {}
+        if SIMULATION_TOP_K and optimized:
+            elites = sorted(optimized, key=lambda i: fitness[i])[:SIMULATION_TOP_K]
+            errors = simulation_errors(
+                [optimized[i] for i in elites],
+                X,
+                add_N,
+                SIMULATION_SUBSTEPS,
+                SIMULATION_BOUND,
+                SIMULATION_METHOD,
+            )
+
+            for error, i in zip(errors, elites):
+                if error is not None:
+                    trajectory_errors[i] = error
+                    continue
+
+                simulation_diverged += 1
+                rejected += 1
+                fitness[i] = PENALTY_FITNESS
+                full_fitness[i] = False
+                del optimized[i]
+
+        for i, optimized_program in optimized.items():
+            if fitness[i] < global_best:
+                global_best = fitness[i]
+                best_prog = optimized_program
 
         mean = sum(fitness) / len(fitness)
+        rejected_per_generation.append(rejected)
 
         if verbose:
             print(
-                f"Generation: {gen + 1}\nBest Score: {global_best}\nMean score: {mean}\nBest program:\n{render_prog(best_prog)}\n"
+                f"Generation: {gen + 1}\nBest Score: {global_best}\nMean score: {mean}\nRejected: {rejected}\nBest program:\n{render_prog(best_prog)}\n"
+            )
+
+        # called once per generation, an exception raised by it stops the search
+        if progress is not None:
+            progress(
+                {
+                    "generation": gen + 1,
+                    "best": global_best,
+                    "mean": mean,
+                    "rejected": rejected,
+                }
             )
 
         if global_best < EPSILON:
             break
 
         member_fitness = [
-            (fitness[i], i, total_population[i]) for i in range(len(total_population))
+            (i not in trajectory_errors, trajectory_errors.get(i, fitness[i]), i)
+            for i in range(len(total_population))
         ]
         member_fitness.sort()
 
-        population = [
-            i[2] for i in member_fitness[: (POP_SIZE - RANDOM_SELECTION_SIZE)]
-        ] + [get_random_parent(total_population) for i in range(RANDOM_SELECTION_SIZE)]
+        selected = [i[2] for i in member_fitness[: (POP_SIZE - RANDOM_SELECTION_SIZE)]]
+        selected += [
+            randint(0, len(total_population) - 1) for _ in range(RANDOM_SELECTION_SIZE)
+        ]
+
+        population = [total_population[i] for i in selected]
+        population_fitness = [fitness[i] if full_fitness[i] else None for i in selected]
+        population_optimized = [optimized.get(i) for i in selected]
+
+        if CHECKPOINT and (gen + 1) % CHECKPOINT_EVERY == 0:
+            save_checkpoint(
+                CHECKPOINT,
+                {
+                    "key": checkpoint_key,
+                    "generation": gen + 1,
+                    "population": population,
+                    "population_fitness": population_fitness,
+                    "population_optimized": population_optimized,
+                    "global_best": global_best,
+                    "best_prog": best_prog,
+                    "full_evaluations": full_evaluations,
+                    "interval_rejected": interval_rejected,
+                    "nonfinite_rejected": nonfinite_rejected,
+                    "rejected_per_generation": rejected_per_generation,
+                    "simulation_diverged": simulation_diverged,
+                    "time": timeit.default_timer() - start,
+                    "random_state": getstate(),
+                    "library_terms": library["terms"] if library else [],
+                },
+            )
 
     best_prog = round_terms_edo_system(system=best_prog, ROUND_SIZE=ROUND_SIZE)
     best_prog = filter_zero_terms_edo_system(system=best_prog)
 
-    prediction = [evaluate(best_prog, Xi) for Xi in X]
-    score = compute_fitness(best_prog, prediction, target, REG_STRENGTH)
+    with np.errstate(all="ignore"):
+        prediction = [evaluate(best_prog, Xi) for Xi in X]
+        if projection is not None:
+            prediction = projection @ np.array(prediction, dtype=float)
+        score = compute_fitness(best_prog, prediction, target, REG_STRENGTH, weights)
+    simulation_error = None
+    if SIMULATION_TOP_K:
+        simulation_error = simulation_errors(
+            [best_prog],
+            X,
+            add_N,
+            SIMULATION_SUBSTEPS,
+            SIMULATION_BOUND,
+            SIMULATION_METHOD,
+        )[0]
     stop = timeit.default_timer()
 
     if verbose:
@@ -178,6 +521,12 @@ def genetic_algorithm(
         "generations": gen + 1,
         "score": score,
         "time": stop - start,
+        "full_evaluations": full_evaluations,
+        "interval_rejected": interval_rejected,
+        "nonfinite_rejected": nonfinite_rejected,
+        "rejected_per_generation": rejected_per_generation,
+        "simulation_diverged": simulation_diverged,
+        "simulation_error": simulation_error,
         "X": X,
         "target": target,
         "MAX_GENERATIONS": MAX_GENERATIONS,
@@ -194,4 +543,21 @@ def genetic_algorithm(
         "REG_STRENGTH": REG_STRENGTH,
         "EPSILON": EPSILON,
         "ROUND_SIZE": ROUND_SIZE,
+        "LIBRARY_DEPTH": LIBRARY_DEPTH,
+        "LIBRARY_MUTATION_PROBABILITY": LIBRARY_MUTATION_PROBABILITY,
+        "LIBRARY_SIZE": library["size"] if library else 0,
+        "FIDELITY_SIZE": FIDELITY_SIZE,
+        "FIDELITY_THRESHOLD": FIDELITY_THRESHOLD,
+        "FIDELITY_SAMPLING": FIDELITY_SAMPLING,
+        "WEIGHTS": WEIGHTS,
+        "INTERVAL_LIMIT": INTERVAL_LIMIT,
+        "PENALTY_FITNESS": PENALTY_FITNESS,
+        "SIMULATION_TOP_K": SIMULATION_TOP_K,
+        "SIMULATION_SUBSTEPS": SIMULATION_SUBSTEPS,
+        "SIMULATION_BOUND": SIMULATION_BOUND,
+        "SIMULATION_METHOD": SIMULATION_METHOD,
+        "seed_systems": len(seed_systems),
+        "CHECKPOINT": CHECKPOINT,
+        "CHECKPOINT_EVERY": CHECKPOINT_EVERY,
+        "resumed_generation": first_generation,
     }
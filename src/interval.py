@@ -0,0 +1,79 @@
+from math import inf, isfinite, isnan
+from src.constants import ZERO
+from src.operation import ADD, DIV, MUL, NEG, SUB
+
+
+def interval_add(a, b):
+    return (a[0] + b[0], a[1] + b[1])
+
+
+def interval_sub(a, b):
+    return (a[0] - b[1], a[1] - b[0])
+
+
+def interval_mul(a, b):
+    products = [a[0] * b[0], a[0] * b[1], a[1] * b[0], a[1] * b[1]]
+    if any(isnan(p) for p in products):
+        return (-inf, inf)
+    return (min(products), max(products))
+
+
+def interval_div(a, b):
+    # safe_div returns a or 1 when the divisor is below ZERO
+    if -ZERO < b[0] and b[1] < ZERO:
+        return (min(a[0], 1), max(a[1], 1))
+
+    # the divisor gets close to zero somewhere in the data range
+    if b[0] < ZERO and b[1] > -ZERO:
+        return (-inf, inf)
+
+    return interval_mul(a, (1 / b[1], 1 / b[0]))
+
+
+def interval_neg(a):
+    return (-a[1], -a[0])
+
+
+INTERVAL_FUNC = {
+    ADD["func"]: interval_add,
+    SUB["func"]: interval_sub,
+    MUL["func"]: interval_mul,
+    DIV["func"]: interval_div,
+    NEG["func"]: interval_neg,
+}
+
+
+def feature_intervals(X_columns):
+    return {k: (float(v.min()), float(v.max())) for k, v in X_columns.items()}
+
+
+def interval_evaluate(node, intervals):
+    if "children" not in node:
+        if "feature_name" in node:
+            return intervals[node["feature_name"]]
+        return (node["value"], node["value"])
+
+    children = [interval_evaluate(c, intervals) for c in node["children"]]
+
+    # operations without an interval version can not be bounded
+    func = INTERVAL_FUNC.get(node["func"])
+    if func is None or None in children:
+        return None
+
+    return func(*children)
+
+
+def bounded_term(term, intervals, INTERVAL_LIMIT):
+    interval = interval_evaluate(term, intervals)
+    if interval is None:
+        return True
+
+    return all(isfinite(i) and abs(i) <= INTERVAL_LIMIT for i in interval)
+
+
+def bounded_system(system, intervals, INTERVAL_LIMIT):
+    return all(
+        bounded_term(edo_term["children"][1], intervals, INTERVAL_LIMIT)
+        for edo_equation in system["children"]
+        for edo_term in edo_equation["children"]
+    )
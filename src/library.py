@@ -0,0 +1,229 @@
+from copy import deepcopy
+from itertools import combinations_with_replacement, product
+from math import comb
+from random import randint, random
+import numpy as np
+from src.nodes import (
+    population_edo_ecuation,
+    population_edo_ecuation_str,
+    population_edo_term,
+    population_edo_term_str,
+    system,
+    system_str,
+)
+from src.cache import content_hash
+from src.operation import DIV, MUL
+from src.utils import evaluate_columns, node_features, render_prog
+
+# libraries larger than this take too long to evaluate and to keep in memory
+MAX_LIBRARY_TERMS = 100000
+
+
+def op_children(lower, op):
+    # children of a commutative operation are taken in one order only
+    if op.get("commutative"):
+        return combinations_with_replacement(lower, op["arg_count"])
+    return product(lower, repeat=op["arg_count"])
+
+
+def count_terms(n_features, operations, LIBRARY_DEPTH):
+    # the size of enumerate_terms, without building any tree
+    counts = [n_features]
+    for _ in range(LIBRARY_DEPTH):
+        total, previous = sum(counts), sum(counts[:-1])
+        level = 0
+        for op in operations:
+            k = op["arg_count"]
+            if op.get("commutative"):
+                level += comb(total + k - 1, k) - comb(previous + k - 1, k)
+            else:
+                level += total**k - previous**k
+        counts.append(level)
+
+    return sum(counts)
+
+
+def enumerate_terms(features_names, operations, LIBRARY_DEPTH):
+    # every tree of depth <= LIBRARY_DEPTH, each level built from the
+    # previous ones with at least one child of the level just before
+    size = count_terms(len(features_names), operations, LIBRARY_DEPTH)
+    if size > MAX_LIBRARY_TERMS:
+        raise ValueError(
+            f"LIBRARY_DEPTH {LIBRARY_DEPTH} gives {size} terms, "
+            f"more than {MAX_LIBRARY_TERMS}"
+        )
+
+    terms = [({"feature_name": f}, 0) for f in features_names]
+
+    for depth in range(1, LIBRARY_DEPTH + 1):
+        lower = list(terms)
+        for op in operations:
+            for children in op_children(lower, op):
+                if max(c[1] for c in children) != depth - 1:
+                    continue
+                terms.append(
+                    (
+                        {
+                            "func": op["func"],
+                            "children": [deepcopy(c[0]) for c in children],
+                            "format_str": op["format_str"],
+                        },
+                        depth,
+                    )
+                )
+
+    return [t[0] for t in terms]
+
+
+def library_append(library, term, column):
+    column = np.broadcast_to(np.asarray(column, dtype=float), (library["n"],))
+
+    # terms with the same values share a column, only a digest is kept
+    column_hash = content_hash(column)
+    if column_hash in library["hashes"]:
+        return library["hashes"][column_hash]
+
+    size = library["size"]
+    if size == library["columns"].shape[1]:
+        columns = np.empty((library["n"], 2 * size))
+        columns[:, :size] = library["columns"]
+        library["columns"] = columns
+
+    library["columns"][:, size] = column
+    library["terms"].append(deepcopy(term))
+    library["hashes"][column_hash] = size
+    library["size"] += 1
+
+    features = node_features(term)
+    for i, equation_features in enumerate(library["equations_features"]):
+        if features <= equation_features:
+            library["allowed"][i].append(size)
+
+    return size
+
+
+def term_column(library, term, X_columns):
+    with np.errstate(all="ignore"):
+        column = np.broadcast_to(
+            evaluate_columns(term, X_columns), (library["samples"],)
+        )
+
+        # weak form columns are stored already projected
+        if library["projection"] is not None:
+            column = library["projection"] @ column
+
+    return column
+
+
+def library_index(library, term, X_columns):
+    key = render_prog(term)
+    if key not in library["keys"]:
+        column = term_column(library, term, X_columns)
+        library["keys"][key] = library_append(library, term, column)
+
+    return library["keys"][key]
+
+
+def library_matrix(library):
+    return library["columns"][:, : library["size"]]
+
+
+def build_library(
+    X_columns, features_names, LIBRARY_DEPTH, operations=(MUL, DIV), projection=None
+):
+    all_features = []
+    for equation_features in features_names:
+        all_features += [f for f in equation_features if f not in all_features]
+
+    samples = len(next(iter(X_columns.values())))
+    n = samples if projection is None else len(projection)
+    library = {
+        "n": n,
+        "samples": samples,
+        "projection": projection,
+        "terms": [],
+        "keys": {},
+        "hashes": {},
+        "columns": np.empty((n, 16)),
+        "size": 0,
+        "equations_features": [set(f) for f in features_names],
+        "allowed": [[] for _ in features_names],
+    }
+
+    for term in enumerate_terms(all_features, operations, LIBRARY_DEPTH):
+        column = term_column(library, term, X_columns)
+
+        # terms that blow up on the data are useless as candidates
+        if not np.all(np.isfinite(column)):
+            continue
+
+        library["keys"][render_prog(term)] = library_append(library, term, column)
+
+    return library
+
+
+def library_edo_term(library, index):
+    return {
+        "func": population_edo_term,
+        "children": [{"value": 1}, deepcopy(library["terms"][index])],
+        "format_str": population_edo_term_str,
+    }
+
+
+def random_library_edo_term(library, equation):
+    allowed = library["allowed"][equation]
+    return library_edo_term(library, allowed[randint(0, len(allowed) - 1)])
+
+
+def random_library_system(system_lenght, library, MAX_DEPTH):
+    return {
+        "func": system,
+        "children": [
+            {
+                "func": population_edo_ecuation,
+                "children": [
+                    random_library_edo_term(library, i)
+                    for _ in range(
+                        randint(1, MAX_DEPTH) if library["allowed"][i] else 0
+                    )
+                ],
+                "format_str": population_edo_ecuation_str,
+            }
+            for i in range(system_lenght)
+        ],
+        "format_str": system_str,
+    }
+
+
+def mutate_library_system(
+    selected, library, DELETE_NODE_PROBABILITY, ADD_OPERATION_PROBABILITY
+):
+    offspring = deepcopy(selected)
+
+    edo_equation = randint(0, len(offspring["children"]) - 1)
+    if not library["allowed"][edo_equation]:
+        return offspring
+
+    terms = offspring["children"][edo_equation]["children"]
+    new_term = random_library_edo_term(library, edo_equation)
+
+    if not terms:
+        terms.append(new_term)
+        return offspring
+
+    r = random()
+    edo_term = randint(0, len(terms) - 1)
+
+    # delete edo term
+    if r < DELETE_NODE_PROBABILITY:
+        terms.pop(edo_term)
+
+    # add edo term
+    elif r < DELETE_NODE_PROBABILITY + ADD_OPERATION_PROBABILITY:
+        terms.append(new_term)
+
+    # swap edo term with another column of the library
+    else:
+        terms[edo_term] = new_term
+
+    return offspring
@@ -1,21 +1,20 @@
 from copy import deepcopy
+from src.library import library_index, library_matrix
 from src.utils import (
     constant_name_assign,
     constant_value_assign,
-    evaluate,
+    evaluate_columns,
     node_count,
+    samples_to_columns,
 )
 import numpy as np
 
 
-def compute_fitness(program, prediction, target, REG_STRENGTH):
-    mse = 0
-    for i in range(len(prediction)):
-        mse_2 = 0
-        for j in range(len(prediction[i])):
-            mse_2 += abs(prediction[i][j] - target[i][j])
-        mse += mse_2 / len(prediction[i])
-    mse /= len(prediction)
+def compute_fitness(program, prediction, target, REG_STRENGTH, weights=None):
+    error = np.abs(
+        np.asarray(prediction, dtype=float) - np.asarray(target, dtype=float)
+    )
+    mse = np.average(np.mean(error, axis=1), weights=weights)
 
     nodes_c = node_count(program)
     if nodes_c < REG_STRENGTH:
@@ -24,7 +23,26 @@ def compute_fitness(program, prediction, target, REG_STRENGTH):
 
 
 def lineal_optimization_system(system, X, target):
+    # the coefficients of the system fitted on samples given row by row
+    offspring, _ = lineal_optimization_system_columns(
+        system, samples_to_columns(X), np.array(target, dtype=float)
+    )
+
+    return offspring
+
+
+def lineal_optimization_system_columns(
+    system, X_columns, target, rows=None, weights=None, library=None, projection=None
+):
     offspring = deepcopy(system)
+    if rows is not None:
+        target = target[rows]
+        if weights is not None:
+            weights = weights[rows]
+        if not library and projection is None:
+            X_columns = {k: v[rows] for k, v in X_columns.items()}
+    samples = len(next(iter(X_columns.values())))
+    prediction = np.zeros(np.shape(target))
 
     for system_i, edo_equation in enumerate(offspring["children"]):
         offspring_edo_equation = deepcopy(edo_equation)
@@ -32,24 +50,50 @@ def lineal_optimization_system(system, X, target):
         constants_count = len(offspring_edo_equation["children"])
 
         if constants_count > 0:
-            A = np.array(
-                [
-                    np.array(
-                        [
-                            evaluate(ode_equation_term["children"][1], X_i)
-                            for ode_equation_term in offspring_edo_equation["children"]
-                        ]
-                    )
-                    for X_i in X
-                ]
-            )
-            b = np.array([y[system_i] for y in target])
-
-            x = np.linalg.lstsq(A, b, rcond=None)[0]
+            terms = [
+                ode_equation_term["children"][1]
+                for ode_equation_term in offspring_edo_equation["children"]
+            ]
+
+            # gather the precomputed columns of the terms or evaluate them
+            if library:
+                indices = [library_index(library, term, X_columns) for term in terms]
+                A = library_matrix(library)[:, indices]
+                if rows is not None:
+                    A = A[rows]
+            else:
+                A = np.column_stack(
+                    [
+                        np.broadcast_to(evaluate_columns(term, X_columns), samples)
+                        for term in terms
+                    ]
+                )
+
+                # weak form, the terms are integrated against the test functions
+                if projection is not None:
+                    A = projection @ A
+                    if rows is not None:
+                        A = A[rows]
+
+            if np.ma.is_masked(np.ma.masked_invalid(A)):
+                return offspring, None
+
+            b = target[:, system_i]
+
+            if weights is not None:
+                x = np.linalg.lstsq(
+                    A * np.sqrt(weights)[:, None], b * np.sqrt(weights), rcond=None
+                )[0]
+            else:
+                x = np.linalg.lstsq(A, b, rcond=None)[0]
+            prediction[:, system_i] = A @ x
 
             offspring_edo_equation, _, _ = constant_name_assign(offspring_edo_equation)
             offspring_edo_equation = constant_value_assign(offspring_edo_equation, x)
 
             offspring["children"][system_i] = offspring_edo_equation
 
-    return offspring
+    if np.ma.is_masked(np.ma.masked_invalid(prediction)):
+        return offspring, None
+
+    return offspring, prediction
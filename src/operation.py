@@ -1,3 +1,4 @@
+import numpy as np
 from src.constants import ZERO
 
 
@@ -9,7 +10,42 @@ def safe_div(a, b):
     return 1
 
 
+def safe_div_array(a, b):
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(np.abs(b) >= ZERO, a / b, np.where(np.abs(a) >= ZERO, a, 1.0))
+
+
+def safe_div_derivative(a, b, da, db):
+    if abs(b) >= ZERO:
+        return (da * b - a * db) / (b * b)
+    elif abs(a) >= ZERO:
+        return da
+    return 0.0
+
+
+def safe_div_derivative_array(a, b, da, db):
+    a, b, da, db = np.broadcast_arrays(
+        *(np.asarray(v, dtype=float) for v in (a, b, da, db))
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(
+            np.abs(b) >= ZERO,
+            (da * b - a * db) / (b * b),
+            np.where(np.abs(a) >= ZERO, da, 0.0),
+        )
+
+
+# functions whose scalar version can not be applied to whole columns
+ARRAY_FUNC = {safe_div: safe_div_array}
+
+
+def array_func(func):
+    return ARRAY_FUNC.get(func, func)
+
+
 ADD = {
+    "commutative": True,
     "func": lambda a, b: a + b,
     "arg_count": 2,
     "format_str": lambda a, b: f"({a} + {b})",
@@ -20,6 +56,7 @@ SUB = {
     "format_str": lambda a, b: f"({a} - {b})",
 }
 MUL = {
+    "commutative": True,
     "func": lambda a, b: a * b,
     "arg_count": 2,
     "format_str": lambda a, b: f"({a} * {b})",
@@ -0,0 +1,142 @@
+import struct
+import numpy as np
+from src import nodes
+from src.operation import ADD, DIV, MUL, NEG, SUB
+
+# programs are stored by operation name, never by code
+OPCODES = {
+    "system": (nodes.system, nodes.system_str),
+    "equation": (nodes.population_edo_ecuation, nodes.population_edo_ecuation_str),
+    "term": (nodes.population_edo_term, nodes.population_edo_term_str),
+    "add": (ADD["func"], ADD["format_str"]),
+    "sub": (SUB["func"], SUB["format_str"]),
+    "mul": (MUL["func"], MUL["format_str"]),
+    "div": (DIV["func"], DIV["format_str"]),
+    "neg": (NEG["func"], NEG["format_str"]),
+}
+OPCODE_NAMES = {func: name for name, (func, _) in OPCODES.items()}
+
+# kinds of the leaves, operations are indexes in the opcode table
+FEATURE = -1
+COEFFICIENT = -2
+
+MAGIC = b"SRP1"
+HEADER = struct.Struct("<HHII")
+CODE = np.dtype([("kind", "<i1"), ("arg", "<u2")])
+
+
+def encode_program(node):
+    # the tree in preorder as (kind, argument) pairs, where the argument is
+    # the number of children of an operation or the index of a leaf in the
+    # feature or coefficient table
+    program = {"opcodes": [], "features": [], "coefficients": [], "code": []}
+    tables = {"opcodes": {}, "features": {}}
+
+    def index(table, name):
+        if name not in tables[table]:
+            tables[table][name] = len(program[table])
+            program[table].append(name)
+        return tables[table][name]
+
+    def encode(node):
+        if "children" not in node:
+            if "feature_name" in node:
+                program["code"] += [FEATURE, index("features", node["feature_name"])]
+            else:
+                program["code"] += [COEFFICIENT, len(program["coefficients"])]
+                program["coefficients"].append(node["value"])
+            return
+
+        name = OPCODE_NAMES.get(node["func"])
+        if name is None:
+            raise ValueError(f"operation without opcode {node['func']}")
+
+        program["code"] += [index("opcodes", name), len(node["children"])]
+        for c in node["children"]:
+            encode(c)
+
+    encode(node)
+
+    return program
+
+
+def decode_program(program):
+    code = iter(program["code"])
+
+    def decode():
+        kind, arg = next(code), next(code)
+        if kind == FEATURE:
+            return {"feature_name": program["features"][arg]}
+        if kind == COEFFICIENT:
+            return {"value": program["coefficients"][arg]}
+
+        func, format_str = OPCODES[program["opcodes"][kind]]
+        return {
+            "func": func,
+            "children": [decode() for _ in range(arg)],
+            "format_str": format_str,
+        }
+
+    return decode()
+
+
+def pack_program(node):
+    program = encode_program(node)
+    names = "\0".join(program["opcodes"] + program["features"]).encode()
+    code = np.array(list(zip(program["code"][::2], program["code"][1::2])), dtype=CODE)
+
+    return b"".join(
+        [
+            HEADER.pack(
+                len(program["opcodes"]),
+                len(program["features"]),
+                len(program["coefficients"]),
+                len(code),
+            ),
+            struct.pack("<I", len(names)),
+            names,
+            np.array(program["coefficients"], dtype="<f8").tobytes(),
+            code.tobytes(),
+        ]
+    )
+
+
+def unpack_program(buffer, offset=0):
+    n_opcodes, n_features, n_coefficients, n_code = HEADER.unpack_from(buffer, offset)
+    offset += HEADER.size
+    (length,) = struct.unpack_from("<I", buffer, offset)
+    offset += 4
+
+    names = bytes(buffer[offset : offset + length]).decode().split("\0")
+    offset += length
+    coefficients = np.frombuffer(buffer, "<f8", n_coefficients, offset)
+    offset += coefficients.nbytes
+    code = np.frombuffer(buffer, CODE, n_code, offset)
+    offset += code.nbytes
+
+    program = {
+        "opcodes": names[:n_opcodes],
+        "features": names[n_opcodes : n_opcodes + n_features],
+        "coefficients": coefficients.tolist(),
+        "code": np.column_stack((code["kind"], code["arg"])).ravel().tolist(),
+    }
+
+    return decode_program(program), offset
+
+
+def write_programs(programs, fp):
+    # programs are written one after the other, so they can be streamed
+    fp.write(MAGIC)
+    for program in programs:
+        packed = pack_program(program)
+        fp.write(struct.pack("<I", len(packed)))
+        fp.write(packed)
+
+
+def read_programs(fp):
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a program stream")
+
+    while size := fp.read(4):
+        (length,) = struct.unpack("<I", size)
+        yield unpack_program(fp.read(length))[0]
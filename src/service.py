@@ -0,0 +1,340 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import re
+import traceback
+import uuid
+from src.cache import content_hash
+from src.utils import load_samples_columns, samples_file_name, save_results
+
+# python -m src.service --socket service.sock
+# curl --unix-socket service.sock localhost/jobs -d '{"samples": "data.csv"}'
+#
+# POST /jobs                 {"samples", "variables", "params"}, a new job
+# GET /jobs                  every job
+# GET /jobs/<id>             status of the job, and its results when done
+# GET /jobs/<id>/progress    one json line per generation until the job ends
+# DELETE /jobs/<id>          cancel the job
+
+FINISHED = ("done", "failed", "cancelled")
+SUMMARY = ["score", "generations", "time", "system_representation"]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_key(columns, variables, params):
+    # the same samples and parameters, seed included, give the same results
+    return content_hash(*(columns[name] for name in variables), variables, params)
+
+
+def run_job(job_id, samples, variables, params, file_name, events, cancelled):
+    # runs in the worker processes, the server only sees the events
+    if job_id in cancelled:
+        raise JobCancelled()
+    events.put({"id": job_id, "status": "running"})
+
+    from src.symbolic_regression import symbolic_regression
+
+    def progress(generation):
+        events.put({"id": job_id, **generation})
+        if job_id in cancelled:
+            raise JobCancelled()
+
+    columns = load_samples_columns(samples)
+    X = [columns[name].tolist() for name in variables]
+    params = dict(params)
+
+    results = symbolic_regression(
+        X,
+        variables,
+        params.pop("smoothing_factor", None),
+        progress=progress,
+        **params,
+    )
+    save_results(dict(results), file_name)
+
+    return {k: results[k] for k in SUMMARY}
+
+
+class Service:
+    def __init__(self, workers=1, results_dir="RESULTS/service"):
+        self.results_dir = results_dir
+        os.makedirs(results_dir, exist_ok=True)
+
+        self.manager = multiprocessing.Manager()
+        self.events = self.manager.Queue()
+        self.cancelled = self.manager.dict()
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+        self.jobs = {}
+        self.by_key = {}
+        self.futures = {}
+        self.changed = {}
+
+    def results_file(self, key):
+        return os.path.join(self.results_dir, key)
+
+    async def submit(self, request):
+        samples = samples_file_name(request["samples"])
+
+        # runs without a seed would not be reproducible, they take the seed
+        # of the command line
+        params = {"seed_g": 0, **request.get("params", {})}
+
+        columns = await asyncio.to_thread(load_samples_columns, samples)
+        variables = request.get("variables") or list(columns)
+        missing = [name for name in variables if name not in columns]
+        if missing:
+            raise ValueError(f"variables not in the samples {missing}")
+
+        key = await asyncio.to_thread(job_key, columns, variables, params)
+
+        # a job with the same inputs that did not fail or was not cancelled
+        # is shared, finished ones are kept in the results directory
+        job_id = self.by_key.get(key)
+        if job_id and self.jobs[job_id]["status"] in ("queued", "running", "done"):
+            return self.jobs[job_id]
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "key": key,
+            "samples": samples,
+            "variables": variables,
+            "params": params,
+            "status": "queued",
+            "progress": [],
+        }
+        self.jobs[job["id"]] = job
+        self.by_key[key] = job["id"]
+        self.changed[job["id"]] = asyncio.Event()
+
+        file_name = self.results_file(key)
+        if os.path.exists(f"{file_name}.json"):
+            with open(f"{file_name}.json") as fp:
+                results = json.load(fp)
+            self.finish(job, "done", results={k: results.get(k) for k in SUMMARY})
+            return job
+
+        future = self.executor.submit(
+            run_job,
+            job["id"],
+            samples,
+            variables,
+            params,
+            file_name,
+            self.events,
+            self.cancelled,
+        )
+        self.futures[job["id"]] = future
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(self.completed, job, f)
+        )
+
+        return job
+
+    def completed(self, job, future):
+        self.futures.pop(job["id"], None)
+        self.cancelled.pop(job["id"], None)
+        if job["status"] in FINISHED:
+            return
+
+        if future.cancelled() or isinstance(future.exception(), JobCancelled):
+            self.finish(job, "cancelled")
+        elif future.exception() is not None:
+            error = future.exception()
+            self.finish(
+                job,
+                "failed",
+                error="".join(traceback.format_exception(error)),
+            )
+        else:
+            self.finish(job, "done", results=future.result())
+
+    def finish(self, job, status, **info):
+        job.update(status=status, **info)
+        self.changed[job["id"]].set()
+
+    def cancel(self, job_id):
+        job = self.jobs[job_id]
+        if job["status"] in FINISHED:
+            return job
+
+        # queued jobs never start, running ones stop at their next generation
+        self.cancelled[job_id] = True
+        future = self.futures.get(job_id)
+        if future is not None:
+            future.cancel()
+
+        return job
+
+    async def dispatch_events(self):
+        while True:
+            event = await asyncio.to_thread(self.events.get)
+            if event is None:
+                return
+
+            job = self.jobs.get(event.pop("id"))
+            if job is None:
+                continue
+
+            if "status" not in event:
+                job["progress"].append(event)
+            elif job["status"] not in FINISHED:
+                job["status"] = event["status"]
+
+            # every waiting client wakes up and a new event is armed
+            self.changed[job["id"]].set()
+            self.changed[job["id"]] = asyncio.Event()
+
+    async def follow(self, job_id):
+        job = self.jobs[job_id]
+        sent = 0
+        while True:
+            changed = self.changed[job_id]
+            for event in job["progress"][sent:]:
+                yield event
+            sent = len(job["progress"])
+
+            if job["status"] in FINISHED:
+                yield {"status": job["status"]}
+                return
+
+            await changed.wait()
+
+    def close(self):
+        for job_id in list(self.futures):
+            self.cancelled[job_id] = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.events.put(None)
+
+
+def job_view(job, results=False):
+    view = {k: v for k, v in job.items() if k not in ("progress", "results")}
+    view["generation"] = len(job["progress"])
+    if results:
+        view["results"] = job.get("results")
+        view["last_progress"] = job["progress"][-1] if job["progress"] else None
+
+    return view
+
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode()
+    if not request_line.strip():
+        return None
+
+    method, path, _ = request_line.split()
+    headers = {}
+    while line := (await reader.readline()).decode().strip():
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+    return method, path, json.loads(body) if body else None
+
+
+def write_response(writer, status, body=None, stream=False):
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}[status]
+    headers = [f"HTTP/1.1 {status} {reason}", "Connection: close"]
+    if stream:
+        headers.append("Content-Type: application/x-ndjson")
+        data = b""
+    else:
+        headers.append("Content-Type: application/json")
+        data = json.dumps(body).encode() + b"\n"
+        headers.append(f"Content-Length: {len(data)}")
+
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + data)
+
+
+def handler(service):
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, body = request
+
+            match = re.fullmatch(r"/jobs(?:/(\w+))?(/progress)?", path)
+            job_id = match and match[1]
+            if match is None or (job_id and job_id not in service.jobs):
+                write_response(writer, 404, {"error": f"no such path {path}"})
+            elif method == "POST" and not job_id:
+                job = await service.submit(body)
+                write_response(writer, 200, job_view(job))
+            elif method == "GET" and not job_id:
+                jobs = [job_view(job) for job in service.jobs.values()]
+                write_response(writer, 200, jobs)
+            elif method == "GET" and match[2]:
+                # the response is streamed until the job ends
+                write_response(writer, 200, stream=True)
+                async for event in service.follow(job_id):
+                    writer.write(json.dumps(event).encode() + b"\n")
+                    await writer.drain()
+            elif method == "GET":
+                write_response(writer, 200, job_view(service.jobs[job_id], True))
+            elif method == "DELETE":
+                write_response(writer, 200, job_view(service.cancel(job_id)))
+            else:
+                write_response(writer, 404, {"error": f"no such path {path}"})
+        except (ValueError, KeyError, TypeError, OSError) as error:
+            write_response(writer, 400, {"error": repr(error)})
+        finally:
+            try:
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    return handle
+
+
+async def serve(service, socket=None, host="127.0.0.1", port=8765):
+    # only local connections, by a unix socket or the loopback interface
+    if socket:
+        server = await asyncio.start_unix_server(handler(service), path=socket)
+    else:
+        server = await asyncio.start_server(handler(service), host, port)
+
+    dispatcher = asyncio.create_task(service.dispatch_events())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await asyncio.to_thread(service.close)
+        await dispatcher
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m src.service",
+        description="Local service running symbolic regression jobs.",
+    )
+    parser.add_argument("--socket", help="unix socket, instead of host and port")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--results-dir", default="RESULTS/service")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = Service(args.workers, args.results_dir)
+    try:
+        asyncio.run(serve(service, args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
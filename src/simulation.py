@@ -0,0 +1,176 @@
+import numpy as np
+from src.utils import (
+    compile_source,
+    jacobian_source,
+    program_source,
+    state_derivatives,
+)
+
+
+def candidate_features(i, time_name, state_names, add_N):
+    features = {time_name: "t"}
+    features.update({name: f"Y[{i}][{j}]" for j, name in enumerate(state_names)})
+    if add_N:
+        features["N"] = "(" + " + ".join(features[j] for j in add_N) + ")"
+
+    return features
+
+
+def active_function(candidates, namespace, shape):
+    # only the candidates still active are evaluated, the function is
+    # compiled again every time some of them are cut off
+    compiled = {}
+
+    def stacked(t, Y, active):
+        key = active.tobytes()
+        if key not in compiled:
+            compiled.clear()
+            rows = np.flatnonzero(active)
+            source = ", ".join(candidates[i] for i in rows)
+            compiled[key] = rows, compile_source(f"lambda t, Y: [{source}]", namespace)
+
+        rows, function = compiled[key]
+        result = np.zeros((len(candidates), *shape))
+        if len(rows):
+            result[rows] = function(float(t), Y.tolist())
+
+        return result
+
+    return stacked
+
+
+def stacked_rhs(systems, time_name, state_names, add_N):
+    # one right hand side for the states of every candidate stacked by rows,
+    # generated as a single function working on python floats
+    namespace = {}
+    candidates = []
+    for i, system in enumerate(systems):
+        features = candidate_features(i, time_name, state_names, add_N)
+        candidates.append(program_source(system, namespace, features, scalar=True))
+
+    return active_function(candidates, namespace, (len(state_names),))
+
+
+def stacked_jacobian(systems, time_name, state_names, add_N):
+    # the analytic jacobians of every candidate stacked as the right hand side
+    namespace = {}
+    derivatives = state_derivatives(state_names, add_N)
+    zero = f"[{', '.join(['0.0'] * len(state_names))}]"
+    candidates = []
+    for i, system in enumerate(systems):
+        features = candidate_features(i, time_name, state_names, add_N)
+        try:
+            candidates.append(
+                jacobian_source(system, derivatives, namespace, features, scalar=True)
+            )
+        except ValueError:
+            # integrated explicitly when it can not be differentiated
+            candidates.append(f"[{', '.join([zero] * len(system['children']))}]")
+
+    return active_function(candidates, namespace, (len(state_names), len(state_names)))
+
+
+def solve_stacked(W, b):
+    try:
+        return np.linalg.solve(W, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return (np.linalg.pinv(W) @ b[..., None])[..., 0]
+
+
+def rk4_step(rhs, jacobian, t, Y, h, active):
+    k1 = rhs(t, Y, active)
+    k2 = rhs(t + h / 2, Y + h / 2 * k1, active)
+    k3 = rhs(t + h / 2, Y + h / 2 * k2, active)
+    k4 = rhs(t + h, Y + h * k3, active)
+
+    return Y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def rosenbrock_step(rhs, jacobian, t, Y, h, active):
+    # two stage rosenbrock method (ROS2), stable for stiff candidates
+    gamma = 1 + 1 / np.sqrt(2)
+    W = np.eye(Y.shape[1]) - gamma * h * jacobian(t, Y, active)
+
+    k1 = solve_stacked(W, rhs(t, Y, active))
+    k2 = solve_stacked(W, rhs(t + h, Y + h * k1, active) - 2 * k1)
+
+    return Y + h * (1.5 * k1 + 0.5 * k2)
+
+
+SIMULATION_METHODS = {
+    "rk4": rk4_step,
+    "rosenbrock": rosenbrock_step,
+}
+
+
+def simulate_systems(
+    systems,
+    X0,
+    t,
+    time_name,
+    state_names,
+    add_N=False,
+    SIMULATION_SUBSTEPS=4,
+    bound=np.inf,
+    SIMULATION_METHOD="rk4",
+):
+    step_method = SIMULATION_METHODS[SIMULATION_METHOD]
+    rhs = stacked_rhs(systems, time_name, state_names, add_N)
+    jacobian = None
+    if SIMULATION_METHOD == "rosenbrock":
+        jacobian = stacked_jacobian(systems, time_name, state_names, add_N)
+
+    Y = np.tile(np.asarray(X0, dtype=float), (len(systems), 1))
+    trajectory = np.full((len(systems), len(t), len(X0)), np.nan)
+    trajectory[:, 0] = Y
+    active = np.ones(len(systems), dtype=bool)
+
+    # fixed amount of steps between samples
+    with np.errstate(all="ignore"):
+        for step in range(1, len(t)):
+            h = (t[step] - t[step - 1]) / SIMULATION_SUBSTEPS
+            for substep in range(SIMULATION_SUBSTEPS):
+                t_i = t[step - 1] + substep * h
+                Y = step_method(rhs, jacobian, t_i, Y, h, active)
+
+            # diverging candidates are cut off and not integrated any more
+            active &= np.all(np.isfinite(Y), axis=1)
+            active &= np.all(np.abs(Y) <= bound, axis=1)
+            if not active.any():
+                break
+
+            trajectory[active, step] = Y[active]
+
+    return trajectory, active
+
+
+def simulation_errors(
+    systems,
+    X,
+    add_N=False,
+    SIMULATION_SUBSTEPS=4,
+    SIMULATION_BOUND=100,
+    SIMULATION_METHOD="rk4",
+):
+    names = list(X[0].keys())
+    time_name = names[0]
+    state_names = names[1 : 1 + len(systems[0]["children"])]
+
+    t = np.array([x[time_name] for x in X], dtype=float)
+    observed = np.array([[x[name] for name in state_names] for x in X], dtype=float)
+
+    trajectory, active = simulate_systems(
+        systems,
+        observed[0],
+        t,
+        time_name,
+        state_names,
+        add_N,
+        SIMULATION_SUBSTEPS,
+        SIMULATION_BOUND * np.abs(observed).max(),
+        SIMULATION_METHOD,
+    )
+
+    errors = np.mean(np.abs(trajectory - observed[None]), axis=(1, 2))
+
+    return [float(e) if a else None for e, a in zip(errors, active)]
@@ -0,0 +1,175 @@
+import json
+import os
+import sqlite3
+import numpy as np
+from src.cache import content_hash
+from src.utils import get_results, load_samples
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS arrays (
+    hash TEXT PRIMARY KEY,
+    dtype TEXT,
+    shape TEXT,
+    data BLOB
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT,
+    noise TEXT,
+    seed INTEGER,
+    name TEXT,
+    score REAL,
+    time REAL,
+    generations INTEGER,
+    dif_gp_original REAL,
+    dif_gp_noise REAL,
+    dif_gp_spline REAL,
+    no_count INTEGER,
+    termination TEXT,
+    system TEXT,
+    system_representation TEXT,
+    names TEXT,
+    samples_hash TEXT,
+    X_hash TEXT,
+    target_hash TEXT,
+    results TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_experiment ON runs (model, noise, seed);
+CREATE VIEW IF NOT EXISTS latest_runs AS
+    SELECT * FROM runs WHERE id IN (SELECT MAX(id) FROM runs GROUP BY model, noise, name);
+"""
+
+# stored in their own columns or as arrays, the rest of the results go to
+# the results column
+RUN_COLUMNS = ["score", "time", "generations", "system_representation"]
+VALIDATION_COLUMNS = ["dif_gp_original", "dif_gp_noise", "dif_gp_spline", "no_count"]
+
+
+def open_store(file_name):
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    conn = sqlite3.connect(file_name, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def store_array(conn, array):
+    # arrays are stored once, runs only keep their hash
+    array = np.ascontiguousarray(array, dtype=float)
+    key = content_hash(array)
+    conn.execute(
+        "INSERT OR IGNORE INTO arrays VALUES (?, ?, ?, ?)",
+        (key, str(array.dtype), json.dumps(array.shape), array.tobytes()),
+    )
+
+    return key
+
+
+def load_array(conn, key):
+    row = conn.execute(
+        "SELECT dtype, shape, data FROM arrays WHERE hash = ?", (key,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    return np.frombuffer(row[2], dtype=row[0]).reshape(json.loads(row[1]))
+
+
+def samples_array(X):
+    names = list(X[0].keys())
+    return names, np.array([[x[name] for name in names] for x in X], dtype=float)
+
+
+def store_run(conn, model, noise, seed, name, results, validation, samples=None):
+    names, X = samples_array(results["X"])
+    others = {
+        k: v
+        for k, v in results.items()
+        if k not in RUN_COLUMNS + ["system", "X", "target"]
+    }
+
+    with conn:
+        row = {
+            "model": model,
+            "noise": None if noise is None else str(noise),
+            "seed": seed,
+            "name": name,
+            **{k: results.get(k) for k in RUN_COLUMNS},
+            **{k: validation.get(k) for k in VALIDATION_COLUMNS},
+            "termination": validation.get("termination"),
+            "system": json.dumps(results["system"]),
+            "names": json.dumps(names),
+            "samples_hash": (
+                store_array(conn, samples_array(samples)[1]) if samples else None
+            ),
+            "X_hash": store_array(conn, X),
+            "target_hash": store_array(conn, results["target"]),
+            "results": json.dumps(others),
+        }
+        conn.execute(
+            f"INSERT INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+            list(row.values()),
+        )
+
+
+def import_run(conn, model, noise, seed, name, save_to):
+    # the files written by make_experiment, the system is kept serialized
+    results = get_results(f"{save_to}/{name}")
+    results["system"] = results.data["system"]
+    with open(f"{save_to}/results_{name}.json") as fp:
+        validation = json.load(fp)
+    samples = load_samples(f"{save_to}/data_{name}")
+
+    store_run(conn, model, noise, seed, name, results, validation, samples)
+
+
+def stored_runs(conn, model=None):
+    query = "SELECT model, noise, name FROM latest_runs"
+    if model is None:
+        return set(conn.execute(query).fetchall())
+
+    return set(conn.execute(f"{query} WHERE model = ?", (model,)).fetchall())
+
+
+def experiment_summary(conn, model):
+    # every aggregate of every noise level of the model in one query, the
+    # systems that did not validate are left out of the differences
+    counted = "CASE WHEN NOT no_count THEN {} END"
+    rows = conn.execute(
+        f"""
+        SELECT
+            noise,
+            COUNT(*),
+            AVG(score),
+            MIN(score),
+            MAX(score),
+            AVG(time),
+            AVG({counted.format("dif_gp_original")}),
+            MIN({counted.format("dif_gp_original")}),
+            MAX({counted.format("dif_gp_original")}),
+            AVG({counted.format("dif_gp_noise")}),
+            AVG({counted.format("dif_gp_spline")}),
+            SUM(NOT no_count)
+        FROM latest_runs
+        WHERE model = ?
+        GROUP BY noise
+        """,
+        (model,),
+    ).fetchall()
+
+    keys = [
+        "tests",
+        "mean",
+        "min",
+        "max",
+        "time",
+        "dif_gp_original",
+        "min_system_value",
+        "max_system_value",
+        "dif_gp_noise",
+        "dif_gp_spline",
+        "evaluated_systems",
+    ]
+
+    return {row[0]: dict(zip(keys, row[1:])) for row in rows}
@@ -1,8 +1,115 @@
 from random import random
-from src.aproximation import derivate, smoothing_spline
+from src.aproximation import estimate_derivative, select_smoothing_factor
+from src.cache import cache_load, cache_save, content_hash
+from src.coreset import (
+    curvature_importance,
+    derivative_importance,
+    leverage_importance,
+    select_coreset,
+)
 from src.genetic_algorithm import genetic_algorithm
-from src.utils import group_with_names, group_without_names
-from matplotlib import pyplot as plt
+from src.lineal_optimization import compute_fitness
+from src.weak_form import test_functions, weak_target
+from src.utils import evaluate, group_with_names, group_without_names
+import numpy as np
+
+
+def preprocess_samples(
+    X,
+    variable_names,
+    smoothing_factor,
+    add_N=False,
+    original_model=None,
+    SPLINE_WORKERS=None,
+    DERIVATIVE_ESTIMATOR=None,
+    DERIVATIVE_OPTIONS=None,
+    SMOOTHING_SELECTION=None,
+    SMOOTHING_GRID=None,
+    WEAK_FORM=None,
+):
+    derivative_cost = None
+    weak_form = None
+
+    if original_model:
+        model = original_model[0]
+        params = original_model[1]
+
+        X_less_last_element = X
+        t_samples = np.asarray(X[0], dtype=float)
+        X_variables = np.asarray(X[1:], dtype=float)
+
+        # the model is evaluated on all the samples at once, models that only
+        # work on scalars are evaluated one time point after the other
+        try:
+            X_dx = [
+                np.broadcast_to(np.asarray(dx, dtype=float), t_samples.shape).tolist()
+                for dx in model(X_variables, t_samples, *params)
+            ]
+        except (TypeError, ValueError):
+            X_dx = np.array(
+                [
+                    model(X_variables[:, t].tolist(), t_samples[t], *params)
+                    for t in range(len(t_samples))
+                ],
+                dtype=float,
+            ).T.tolist()
+
+    elif WEAK_FORM:
+        # no derivatives, the states are integrated against test functions
+        X_less_last_element = X
+        X_dx = None
+        weak_form = WEAK_FORM
+
+    else:
+        # choose the smoothing factor of every variable before the spline fit
+        if SMOOTHING_SELECTION:
+            smoothing_factor, _ = select_smoothing_factor(
+                X[0], X[1:], SMOOTHING_GRID, SMOOTHING_SELECTION, SPLINE_WORKERS
+            )
+            DERIVATIVE_ESTIMATOR = DERIVATIVE_ESTIMATOR or "spline"
+
+        # central differences when there is no smoothing factor to fit with
+        if DERIVATIVE_ESTIMATOR is None and smoothing_factor is None:
+            DERIVATIVE_ESTIMATOR = "central"
+        elif DERIVATIVE_ESTIMATOR is None:
+            DERIVATIVE_ESTIMATOR = "forward" if smoothing_factor[0] == 1 else "spline"
+
+        options = dict(DERIVATIVE_OPTIONS or {})
+        if DERIVATIVE_ESTIMATOR == "spline":
+            options.setdefault("smoothing_factor", smoothing_factor)
+            options.setdefault("workers", SPLINE_WORKERS)
+
+        X_less_last_element, X_dx, derivative_cost = estimate_derivative(
+            DERIVATIVE_ESTIMATOR, X[0], X[1:], **options
+        )
+
+    X_samples = group_with_names(X_less_last_element, variable_names)
+
+    if weak_form:
+        _, d_projection = test_functions(X[0], weak_form)
+        target = weak_target(d_projection, X[1:]).tolist()
+    else:
+        target = group_without_names(X_dx)
+
+    if add_N:
+        for i in X_samples:
+            sum = 0
+            for j in add_N:
+                sum += i[j]
+            i["N"] = sum
+
+    return (
+        X_less_last_element,
+        X_dx,
+        X_samples,
+        target,
+        {
+            "derivative_cost": derivative_cost,
+            "smoothing_factor": smoothing_factor,
+            "DERIVATIVE_ESTIMATOR": DERIVATIVE_ESTIMATOR,
+            "weak_form": weak_form,
+        },
+    )
 
 
 def symbolic_regression(
@@ -28,36 +135,104 @@ def symbolic_regression(
     verbose=False,
     show_spline=False,
     original_model=None,
+    LIBRARY_DEPTH=None,
+    LIBRARY_MUTATION_PROBABILITY=0.5,
+    FIDELITY_SIZE=None,
+    FIDELITY_THRESHOLD=1.0,
+    FIDELITY_SAMPLING="random",
+    CORESET_SIZE=None,
+    CORESET_METHOD="curvature",
+    CORESET_VALIDATE=True,
+    INTERVAL_LIMIT=None,
+    PENALTY_FITNESS=1e30,
+    SPLINE_WORKERS=None,
+    DERIVATIVE_ESTIMATOR=None,
+    DERIVATIVE_OPTIONS=None,
+    SMOOTHING_SELECTION=None,
+    SMOOTHING_GRID=None,
+    CACHE_DIR=None,
+    CACHE_SIZE=2**30,
+    WEAK_FORM=None,
+    SIMULATION_TOP_K=None,
+    SIMULATION_SUBSTEPS=4,
+    SIMULATION_BOUND=100,
+    SIMULATION_METHOD="rk4",
+    SEED_SYSTEMS=None,
+    CHECKPOINT=None,
+    CHECKPOINT_EVERY=10,
+    progress=None,
 ):
+    # preprocessing only depends on the data and the derivative settings
+    key = None
+    cached = None
+    if CACHE_DIR:
+        key = content_hash(
+            np.asarray(X, dtype=float),
+            variable_names,
+            smoothing_factor,
+            add_N,
+            original_model and original_model[0],
+            original_model and list(original_model[1]),
+            DERIVATIVE_ESTIMATOR,
+            DERIVATIVE_OPTIONS,
+            SMOOTHING_SELECTION,
+            SMOOTHING_GRID,
+            WEAK_FORM,
+        )
+        cached = cache_load(CACHE_DIR, key)
 
-    if original_model:
-        model = original_model[0]
-        params = original_model[1]
-
-        X_less_last_element = X
-        X_dx = [[] for _ in range(len(X[1:]))]
-
-        t_samples = X[0]
-        for t in range(len(t_samples)):
-            X_variables = []
-
-            for variable in range(len(X[1:])):
-                X_variables.append(X[1:][variable][t])
-
-            X_i = model(X_variables, t_samples[t], *params)
+    if cached:
+        preprocessing = cached["meta"]
+        X_samples = [
+            dict(zip(preprocessing["names"], row)) for row in cached["samples"].tolist()
+        ]
+        target = cached["target"].tolist()
+        X_less_last_element = cached["samples"][:, : len(variable_names)].T.tolist()
+        X_dx = cached["target"].T.tolist()
+        if cached["meta"]["weak_form"]:
+            X_dx = None
+    else:
+        X_less_last_element, X_dx, X_samples, target, preprocessing = (
+            preprocess_samples(
+                X,
+                variable_names,
+                smoothing_factor,
+                add_N,
+                original_model,
+                SPLINE_WORKERS,
+                DERIVATIVE_ESTIMATOR,
+                DERIVATIVE_OPTIONS,
+                SMOOTHING_SELECTION,
+                SMOOTHING_GRID,
+                WEAK_FORM,
+            )
+        )
 
-            for variable in range(len(X[1:])):
-                X_dx[variable].append(X_i[variable])
+        if CACHE_DIR:
+            names = list(X_samples[0].keys())
+            cache_save(
+                CACHE_DIR,
+                key,
+                {
+                    "samples": [[x[k] for k in names] for x in X_samples],
+                    "target": target,
+                },
+                {**preprocessing, "names": names},
+                CACHE_SIZE,
+            )
 
-    elif smoothing_factor[0] == 1:
-        X_dx = derivate(X[0], X[1:])
-        X_less_last_element = [x[:-1] for x in X]
-    else:
-        X_less_last_element, X_dx = smoothing_spline(X[0], X[1:], smoothing_factor)
+    smoothing_factor = preprocessing["smoothing_factor"]
+    DERIVATIVE_ESTIMATOR = preprocessing["DERIVATIVE_ESTIMATOR"]
+    # a run reading the preprocessing from the cache did not spend its cost
+    derivative_cost = None if cached else preprocessing["derivative_cost"]
 
-    X_samples = group_with_names(X_less_last_element, variable_names)
+    projection = None
+    if preprocessing["weak_form"]:
+        projection, _ = test_functions(X_less_last_element[0], WEAK_FORM)
 
     if show_spline:
+        from matplotlib import pyplot as plt
+
         for i, variable_name in enumerate(variable_names[1:]):
             plt.plot(
                 X_less_last_element[0],
@@ -68,17 +243,28 @@ def symbolic_regression(
         plt.legend()
         plt.show()
 
-    target = group_without_names(X_dx)
-    if add_N:
-        for i in X_samples:
-            sum = 0
-            for j in add_N:
-                sum += i[j]
-            i["N"] = sum
+    X_fit, target_fit, weights = X_samples, target, None
+    if CORESET_SIZE:
+        if projection is not None:
+            raise ValueError("CORESET_SIZE can not be used with WEAK_FORM")
+
+        if CORESET_METHOD == "leverage":
+            importance = leverage_importance(
+                X_samples,
+                FEATURES_NAMES or [list(X_samples[0].keys()) for _ in target[0]],
+            )
+        elif CORESET_METHOD == "derivative":
+            importance = derivative_importance(X_less_last_element[0], X_dx)
+        else:
+            importance = curvature_importance(X_less_last_element[0], X_dx)
+
+        rows, weights = select_coreset(importance, CORESET_SIZE)
+        X_fit = [X_samples[i] for i in rows]
+        target_fit = [target[i] for i in rows]
 
     ret = genetic_algorithm(
-        X_samples,
-        target,
+        X_fit,
+        target_fit,
         MAX_GENERATIONS,
         seed_g,
         MAX_DEPTH,
@@ -95,6 +281,50 @@ def symbolic_regression(
         EPSILON,
         ROUND_SIZE,
         verbose,
+        LIBRARY_DEPTH=LIBRARY_DEPTH,
+        LIBRARY_MUTATION_PROBABILITY=LIBRARY_MUTATION_PROBABILITY,
+        FIDELITY_SIZE=FIDELITY_SIZE,
+        FIDELITY_THRESHOLD=FIDELITY_THRESHOLD,
+        FIDELITY_SAMPLING=FIDELITY_SAMPLING,
+        WEIGHTS=weights,
+        INTERVAL_LIMIT=INTERVAL_LIMIT,
+        PENALTY_FITNESS=PENALTY_FITNESS,
+        SIMULATION_TOP_K=SIMULATION_TOP_K,
+        SIMULATION_SUBSTEPS=SIMULATION_SUBSTEPS,
+        SIMULATION_BOUND=SIMULATION_BOUND,
+        SIMULATION_METHOD=SIMULATION_METHOD,
+        SEED_SYSTEMS=SEED_SYSTEMS,
+        CHECKPOINT=CHECKPOINT,
+        CHECKPOINT_EVERY=CHECKPOINT_EVERY,
+        add_N=add_N,
+        projection=projection,
+        progress=progress,
     )
 
+    ret["DERIVATIVE_ESTIMATOR"] = DERIVATIVE_ESTIMATOR
+    ret["DERIVATIVE_OPTIONS"] = DERIVATIVE_OPTIONS
+    ret["derivative_cost"] = derivative_cost
+    ret["preprocessing_cached"] = bool(cached)
+    ret["WEAK_FORM"] = preprocessing["weak_form"]
+    ret["smoothing_factor"] = smoothing_factor
+    ret["SMOOTHING_SELECTION"] = SMOOTHING_SELECTION
+    ret["SMOOTHING_GRID"] = SMOOTHING_GRID
+
+    if CORESET_SIZE:
+        ret["coreset_rows"] = rows
+        ret["coreset_score"] = ret["score"]
+        ret["CORESET_SIZE"] = CORESET_SIZE
+        ret["CORESET_METHOD"] = CORESET_METHOD
+        ret["CORESET_VALIDATE"] = CORESET_VALIDATE
+
+        # the experiments compare against every sample, not only the coreset
+        ret["X"] = X_samples
+        ret["target"] = target
+
+        if CORESET_VALIDATE:
+            prediction = [evaluate(ret["system"], Xi) for Xi in X_samples]
+            ret["score"] = compute_fitness(
+                ret["system"], prediction, target, REG_STRENGTH
+            )
+
     return ret
@@ -1,3 +1,4 @@
+from collections.abc import MutableMapping
 from copy import deepcopy
 import json
 import marshal
@@ -5,8 +6,45 @@ import base64
 import types
 import numpy as np
 from src.constants import ZERO
+from src import nodes
+from src.operation import (
+    ADD,
+    DIV,
+    MUL,
+    NEG,
+    SUB,
+    array_func,
+    safe_div,
+    safe_div_array,
+    safe_div_derivative,
+    safe_div_derivative_array,
+)
+from src.serialization import decode_program, encode_program
 import csv
+from itertools import islice
 import os
+import struct
+
+OPERATION_SOURCE = {
+    nodes.population_edo_term: "({} * {})",
+    ADD["func"]: "({} + {})",
+    SUB["func"]: "({} - {})",
+    MUL["func"]: "({} * {})",
+    DIV["func"]: "safe_div_array({}, {})",
+    NEG["func"]: "(-{})",
+}
+
+# functions of the repo are given back as themselves by deserialize_system,
+# so they are still recognized by identity
+KNOWN_FUNCTIONS = [
+    nodes.system,
+    nodes.system_str,
+    nodes.population_edo_ecuation,
+    nodes.population_edo_ecuation_str,
+    nodes.population_edo_term,
+    nodes.population_edo_term_str,
+    *(op[key] for op in (ADD, SUB, MUL, DIV, NEG) for key in ("func", "format_str")),
+]
 
 
 def constant_name_assign(selected, number=0, constant=[]):
@@ -65,6 +103,136 @@ def evaluate(node, row):
     return node["func"](*[evaluate(c, row) for c in node["children"]])
 
 
+def evaluate_columns(node, columns):
+    if "children" not in node:
+        if "feature_name" in node:
+            return columns[node["feature_name"]]
+        return node["value"]
+    return array_func(node["func"])(
+        *[evaluate_columns(c, columns) for c in node["children"]]
+    )
+
+
+def program_source(node, namespace, features=None, scalar=False):
+    if "children" not in node:
+        if "feature_name" in node:
+            if features:
+                return features[node["feature_name"]]
+            return f"c[{node['feature_name']!r}]"
+        return repr(float(node["value"]))
+
+    children = [
+        program_source(c, namespace, features, scalar) for c in node["children"]
+    ]
+
+    return operation_source(node["func"], children, namespace, scalar)
+
+
+def operation_source(func, children, namespace, scalar=False):
+    if func is nodes.system:
+        return f"({', '.join(children)},)"
+    if func is nodes.population_edo_ecuation:
+        return " + ".join(children) or "0.0"
+    if func is DIV["func"] and scalar:
+        return f"safe_div({', '.join(children)})"
+    if func in OPERATION_SOURCE:
+        return OPERATION_SOURCE[func].format(*children)
+
+    # functions without source are called from the namespace
+    name = f"f{len(namespace)}"
+    namespace[name] = func if scalar else array_func(func)
+    return f"{name}({', '.join(children)})"
+
+
+def derivative_source(node, derivatives, namespace, features=None, scalar=False):
+    # source of the value and of the derivative of node, the derivative of
+    # every feature is given by derivatives, None stands for zero
+    if "children" not in node:
+        value = program_source(node, namespace, features, scalar)
+        return value, derivatives.get(node.get("feature_name"))
+
+    children = [
+        derivative_source(c, derivatives, namespace, features, scalar)
+        for c in node["children"]
+    ]
+    values = [c[0] for c in children]
+    d = [c[1] for c in children]
+    func = node["func"]
+    value = operation_source(func, values, namespace, scalar)
+
+    if func is nodes.system:
+        raise ValueError("differentiate the equations of the system one by one")
+
+    if func is nodes.population_edo_ecuation or func is ADD["func"]:
+        d = [i for i in d if i is not None]
+        return value, "(" + " + ".join(d) + ")" if d else None
+    if func is SUB["func"]:
+        if d[1] is None:
+            return value, d[0]
+        return value, f"({d[0] or 0.0} - {d[1]})"
+    if func is NEG["func"]:
+        return value, f"(-{d[0]})" if d[0] is not None else None
+    if func is MUL["func"] or func is nodes.population_edo_term:
+        d = [f"({values[1 - i]} * {d[i]})" for i in range(2) if d[i] is not None]
+        return value, "(" + " + ".join(d) + ")" if d else None
+    if func is DIV["func"]:
+        if d[0] is None and d[1] is None:
+            return value, None
+        div = "safe_div_derivative" if scalar else "safe_div_derivative_array"
+        return value, f"{div}({values[0]}, {values[1]}, {d[0] or 0.0}, {d[1] or 0.0})"
+
+    if all(i is None for i in d):
+        return value, None
+    raise ValueError(f"can not differentiate {func}")
+
+
+def state_derivatives(state_names, add_N=False):
+    # derivatives of the features with respect to every state, N is the sum
+    # of the states in add_N
+    return [
+        {name: "1.0", **({"N": "1.0"} if add_N and name in add_N else {})}
+        for name in state_names
+    ]
+
+
+def jacobian_source(system, state_features, namespace, features=None, scalar=False):
+    # rows are the equations and columns the states, the derivative of every
+    # derived feature (as N) with respect to each state is given too
+    rows = []
+    for edo_equation in system["children"]:
+        row = []
+        for derivatives in state_features:
+            _, d = derivative_source(
+                edo_equation, derivatives, namespace, features, scalar
+            )
+            row.append(d or "0.0")
+        rows.append(f"[{', '.join(row)}]")
+
+    return f"[{', '.join(rows)}]"
+
+
+def compile_source(source, namespace=None):
+    namespace = {
+        "safe_div": safe_div,
+        "safe_div_array": safe_div_array,
+        "safe_div_derivative": safe_div_derivative,
+        "safe_div_derivative_array": safe_div_derivative_array,
+        "inf": np.inf,
+        "nan": np.nan,
+        **(namespace or {}),
+    }
+
+    return eval(source, namespace)
+
+
+def node_features(node):
+    if "children" not in node:
+        if "feature_name" in node:
+            return {node["feature_name"]}
+        return set()
+    return set().union(*[node_features(c) for c in node["children"]])
+
+
 def render_prog(node):
     if "children" not in node:
         if "feature_name" in node:
@@ -143,6 +311,26 @@ def serialize_system(node):
     return offspring
 
 
+def code_key(code):
+    # the names of the arguments tell apart functions with the same body,
+    # as the product of MUL and of the terms of an equation
+    return (
+        code.co_argcount,
+        code.co_code,
+        code.co_consts,
+        code.co_names,
+        code.co_varnames,
+    )
+
+
+def load_function(code):
+    for func in KNOWN_FUNCTIONS:
+        if code_key(func.__code__) == code_key(code):
+            return func
+
+    return types.FunctionType(code, globals())
+
+
 def deserialize_system(node):
     offspring = deepcopy(node)
 
@@ -151,12 +339,12 @@ def deserialize_system(node):
 
     func_code_string = base64.b64decode(offspring["func"])
     func_code_marshal = marshal.loads(func_code_string)
-    func_code_base64 = types.FunctionType(func_code_marshal, globals())
+    func_code_base64 = load_function(func_code_marshal)
     offspring["func"] = func_code_base64
 
     format_code_string = base64.b64decode(offspring["format_str"])
     format_code_marshal = marshal.loads(format_code_string)
-    format_code_base64 = types.FunctionType(format_code_marshal, globals())
+    format_code_base64 = load_function(format_code_marshal)
     offspring["format_str"] = format_code_base64
 
     child_number = len(offspring["children"])
@@ -166,24 +354,95 @@ def deserialize_system(node):
     return offspring
 
 
+def load_system(data):
+    # the system field of the results of any version
+    if "code" in data:
+        return decode_program(data)
+
+    return deserialize_system(data)
+
+
 def save_results(results, file_name):
-    offsprint = deepcopy(results["system"])
-    results["system"] = serialize_system(offsprint)
+    try:
+        results["system"] = encode_program(results["system"])
+    except ValueError:
+        # operations without opcode keep the marshal format
+        offsprint = deepcopy(results["system"])
+        results["system"] = serialize_system(offsprint)
+
+    # the samples are saved aside in binary, the json only keeps metadata
+    metadata = {k: v for k, v in results.items() if k not in ("X", "target")}
+    if "X" in results:
+        names = list(results["X"][0].keys())
+        np.savez(
+            f"{file_name}.npz",
+            names=np.array(names),
+            X=np.array([[x[k] for k in names] for x in results["X"]], dtype=float),
+            target=np.array(results["target"], dtype=float),
+        )
 
     with open(f"{file_name}.json", "w") as fp:
-        json.dump(results, fp)
+        json.dump(metadata, fp)
 
     return results
 
 
+class Results(MutableMapping):
+    # results of a run as returned by get_results, the system, X and target
+    # are decoded the first time they are used
+
+    def __init__(self, data, file_name):
+        self.data = data
+        self.decoders = {"system": lambda: {"system": load_system(data["system"])}}
+
+        # results saved before the samples were kept aside have them inline,
+        # X and target are read together from the same file
+        if "X" not in data and os.path.exists(f"{file_name}.npz"):
+            samples = lambda: dict(
+                zip(["X", "target"], load_results_samples(file_name))
+            )
+            self.decoders["X"] = self.decoders["target"] = samples
+
+    def __getitem__(self, key):
+        decoder = self.decoders.pop(key, None)
+        if decoder:
+            # the other values of the decoder are kept unless set meanwhile
+            for k, value in decoder().items():
+                if k == key or self.decoders.pop(k, None):
+                    self.data[k] = value
+
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.decoders.pop(key, None)
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        if self.decoders.pop(key, None) and key not in self.data:
+            return
+        del self.data[key]
+
+    def __iter__(self):
+        return iter({**self.data, **dict.fromkeys(self.decoders)})
+
+    def __len__(self):
+        return len(self.data.keys() | self.decoders.keys())
+
+
+def load_results_samples(file_name):
+    with np.load(f"{file_name}.npz") as arrays:
+        names = arrays["names"].tolist()
+        X = [dict(zip(names, x)) for x in arrays["X"].tolist()]
+        target = arrays["target"].tolist()
+
+    return X, target
+
+
 def get_results(file_name):
     with open(f"{file_name}.json") as json_file:
         data = json.load(json_file)
 
-    offspring = deepcopy(data["system"])
-    data["system"] = deserialize_system(offspring)
-
-    return data
+    return Results(data, file_name)
 
 
 def save_samples(X, file_name):
@@ -215,6 +474,77 @@ def load_samples(file_name):
     return X
 
 
+COLUMNS_MAGIC = b"SRCOLS1\0"
+
+
+def columns_offset(header_length):
+    # the data starts aligned to 64 bytes after the header
+    return -(-(len(COLUMNS_MAGIC) + 8 + header_length) // 64) * 64
+
+
+def save_samples_columns(X, file_name):
+    # one float64 column after the other behind a small json header, so the
+    # columns are memory-mapped without parsing
+    if not len(X):
+        return
+
+    names = list(X[0].keys())
+    data = np.array([[x[k] for x in X] for k in names], dtype="<f8")
+    header = json.dumps({"names": names, "rows": len(X), "dtype": "<f8"}).encode()
+    padding = columns_offset(len(header)) - len(COLUMNS_MAGIC) - 8 - len(header)
+
+    directory = os.path.dirname(f"{file_name}.cols")
+    os.makedirs(directory, exist_ok=True)
+
+    with open(f"{file_name}.cols", "wb") as fp:
+        fp.write(COLUMNS_MAGIC)
+        fp.write(struct.pack("<Q", len(header)))
+        fp.write(header)
+        fp.write(b"\0" * padding)
+        fp.write(data.tobytes())
+
+
+def samples_file_name(path):
+    # sample files are given with or without their extension
+    file_name, extension = os.path.splitext(path)
+    if extension not in (".csv", ".cols"):
+        return path
+    return file_name
+
+
+def load_samples_columns(file_name):
+    # samples saved only as csv are read in chunks
+    if not os.path.exists(f"{file_name}.cols"):
+        chunks = list(read_samples_chunks(file_name))
+        return {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+
+    with open(f"{file_name}.cols", "rb") as fp:
+        if fp.read(len(COLUMNS_MAGIC)) != COLUMNS_MAGIC:
+            raise ValueError(f"{file_name}.cols is not a columns file")
+        (length,) = struct.unpack("<Q", fp.read(8))
+        header = json.loads(fp.read(length))
+
+    data = np.memmap(
+        f"{file_name}.cols",
+        dtype=header["dtype"],
+        mode="r",
+        offset=columns_offset(length),
+        shape=(len(header["names"]), header["rows"]),
+    )
+
+    return dict(zip(header["names"], data))
+
+
+def read_samples_chunks(file_name, chunk_size=100000):
+    # columns of at most chunk_size samples, for csv files larger than memory
+    with open(f"{file_name}.csv", newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        names = next(reader)
+
+        while rows := list(islice(reader, chunk_size)):
+            yield dict(zip(names, np.array(rows, dtype=float).T))
+
+
 def group_without_names(X):
     result = []
     for i in range(len(X[0])):
@@ -227,6 +557,10 @@ def group_without_names(X):
     return result
 
 
+def samples_to_columns(X):
+    return {k: np.array([x[k] for x in X], dtype=float) for k in X[0]}
+
+
 def group_with_names(X, variable_names):
     ret = [
         {variable_names[j]: X[j][i] for j in range(len(variable_names))}
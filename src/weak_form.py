@@ -0,0 +1,37 @@
+import numpy as np
+
+
+def trapezoid_weights(t):
+    t = np.asarray(t, dtype=float)
+    h = np.diff(t)
+
+    weights = np.zeros(len(t))
+    weights[:-1] += h / 2
+    weights[1:] += h / 2
+
+    return weights
+
+
+def test_functions(t, WEAK_FORM, power=2):
+    # WEAK_FORM bumps ((t - a)(b - t))^power overlapping by half their
+    # support, they vanish with their derivative at the ends of it
+    t = np.asarray(t, dtype=float)
+    width = 2 * (t[-1] - t[0]) / (WEAK_FORM + 1)
+    a = t[0] + np.arange(WEAK_FORM)[:, None] * width / 2
+    b = a + width
+
+    inside = (t > a) & (t < b)
+    base = np.where(inside, (t - a) * (b - t), 0)
+    scale = (width / 2) ** (2 * power)
+
+    phi = base**power / scale
+    d_phi = np.where(inside, power * base ** (power - 1) * (a + b - 2 * t), 0) / scale
+
+    weights = trapezoid_weights(t)
+
+    return phi * weights, d_phi * weights
+
+
+def weak_target(d_projection, X):
+    # integration by parts of the derivative against every test function
+    return -(d_projection @ np.asarray(X, dtype=float).T)